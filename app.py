@@ -1,21 +1,144 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, make_response, session, send_file
+from flask import Flask, render_template, stream_template, stream_with_context, request, redirect, url_for, flash, send_from_directory, make_response, session, send_file, g, has_app_context, has_request_context, jsonify, before_render_template, template_rendered
 import sqlite3
 import os
-from datetime import datetime, timedelta
+import base64
+import contextvars
+import bisect
+import csv
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import queue
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 import secrets
 import pytz
+import click
+import functools
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'supersecretkey'
-
-# Definir la ruta de la base de datos dinámicamente
-if os.getenv('RENDER'):
+# Paginación del listado de productos
+app.config['PRODUCTS_PAGE_SIZE'] = int(os.getenv('PRODUCTS_PAGE_SIZE', 50))
+app.config['PRODUCTS_MAX_PAGE_SIZE'] = int(os.getenv('PRODUCTS_MAX_PAGE_SIZE', 200))
+# Renderizado en streaming: los primeros bytes salen antes de terminar la consulta
+app.config['STREAM_TEMPLATES'] = os.getenv('STREAM_TEMPLATES', '0') == '1'
+
+# Definir la ruta de la base de datos dinámicamente (DATABASE_PATH la fija explícitamente, p. ej. en benchmark.py)
+if os.getenv('DATABASE_PATH'):
+    DATABASE = os.getenv('DATABASE_PATH')
+elif os.getenv('RENDER'):
     DATABASE = '/opt/render/project/src/database.db'
 else:
     DATABASE = os.path.join(os.path.dirname(__file__), 'database.db')
 
+# Pool de conexiones SQLite por worker
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 8))
+app.config['DB_POOL_TIMEOUT'] = float(os.getenv('DB_POOL_TIMEOUT', 10))
+app.config['DB_BUSY_TIMEOUT_MS'] = int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))
+app.config['DB_LOCK_RETRIES'] = int(os.getenv('DB_LOCK_RETRIES', 3))
+app.config['DB_MMAP_SIZE'] = int(os.getenv('DB_MMAP_SIZE', 256 * 1024 * 1024))
+app.config['DB_CACHE_SIZE_KB'] = int(os.getenv('DB_CACHE_SIZE_KB', 20000))
+# Cada cuántos segundos se comprueba si el archivo de la base fue reemplazado
+app.config['DB_STAT_INTERVAL'] = float(os.getenv('DB_STAT_INTERVAL', 1))
+
+# Caché en memoria de usuarios para load_user()
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = float(os.getenv('USER_CACHE_TTL', 300))
+
+# Importación masiva de precios: filas por transacción
+app.config['IMPORT_CHUNK_SIZE'] = int(os.getenv('IMPORT_CHUNK_SIZE', 5000))
+app.config['IMPORT_MAX_REPORTED_ERRORS'] = int(os.getenv('IMPORT_MAX_REPORTED_ERRORS', 100))
+
+# Exportación: páginas copiadas por paso del backup y filas por lote del streaming
+app.config['EXPORT_BACKUP_PAGES'] = int(os.getenv('EXPORT_BACKUP_PAGES', 1024))
+app.config['EXPORT_BATCH_SIZE'] = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+# Tiempo máximo de espera por el lock de migraciones cuando otro worker está migrando
+app.config['MIGRATION_LOCK_TIMEOUT'] = float(os.getenv('MIGRATION_LOCK_TIMEOUT', 600))
+
+# Filas por transacción al fusionar una base subida
+app.config['MERGE_BATCH_SIZE'] = int(os.getenv('MERGE_BATCH_SIZE', 5000))
+
+# Chat en tiempo real: intervalo de consulta a la base, mensajes en memoria y duración de cada stream
+app.config['CHAT_POLL_INTERVAL'] = float(os.getenv('CHAT_POLL_INTERVAL', 1))
+app.config['CHAT_BUFFER_SIZE'] = int(os.getenv('CHAT_BUFFER_SIZE', 200))
+app.config['CHAT_HEARTBEAT_SECONDS'] = float(os.getenv('CHAT_HEARTBEAT_SECONDS', 15))
+app.config['CHAT_STREAM_MAX_SECONDS'] = float(os.getenv('CHAT_STREAM_MAX_SECONDS', 300))
+app.config['CHAT_LONG_POLL_SECONDS'] = float(os.getenv('CHAT_LONG_POLL_SECONDS', 25))
+# Duración máxima del stream con workers síncronos (por debajo del timeout de 30 s de gunicorn)
+app.config['CHAT_SYNC_STREAM_MAX_SECONDS'] = float(os.getenv('CHAT_SYNC_STREAM_MAX_SECONDS', 20))
+# Historial del chat: mensajes por página y retención antes de archivar
+app.config['CHAT_PAGE_SIZE'] = int(os.getenv('CHAT_PAGE_SIZE', 50))
+app.config['CHAT_RETENTION_DAYS'] = int(os.getenv('CHAT_RETENTION_DAYS', 90))
+app.config['CHAT_ARCHIVE_BATCH_SIZE'] = int(os.getenv('CHAT_ARCHIVE_BATCH_SIZE', 1000))
+app.config['USERNAME_CACHE_SIZE'] = int(os.getenv('USERNAME_CACHE_SIZE', 10000))
+
+# Canasta más barata: máximo de lugares para dividir la compra y lugares evaluados
+app.config['BASKET_MAX_STORES'] = int(os.getenv('BASKET_MAX_STORES', 3))
+app.config['BASKET_CANDIDATE_STORES'] = int(os.getenv('BASKET_CANDIDATE_STORES', 30))
+
+# Historial de precios: series en caché, productos por consulta y ventana máxima en días
+app.config['PRICE_HISTORY_CACHE_SIZE'] = int(os.getenv('PRICE_HISTORY_CACHE_SIZE', 2048))
+app.config['PRICE_HISTORY_MAX_PRODUCTS'] = int(os.getenv('PRICE_HISTORY_MAX_PRODUCTS', 50))
+app.config['PRICE_HISTORY_MAX_DAYS'] = int(os.getenv('PRICE_HISTORY_MAX_DAYS', 730))
+
+# Fechas ya formateadas que se guardan en memoria (una entrada por segundo distinto)
+app.config['TIMESTAMP_CACHE_SIZE'] = int(os.getenv('TIMESTAMP_CACHE_SIZE', 8192))
+
+# Caché de páginas públicas: entradas y bytes en memoria, y directorio opcional compartido entre workers
+app.config['RESPONSE_CACHE_SIZE'] = int(os.getenv('RESPONSE_CACHE_SIZE', 256))
+app.config['RESPONSE_CACHE_MAX_BYTES'] = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+app.config['RESPONSE_CACHE_DIR'] = os.getenv('RESPONSE_CACHE_DIR') or None
+
+# Archivos estáticos con huella en la URL: caché del navegador por un año
+app.config['STATIC_ASSET_MAX_AGE'] = int(os.getenv('STATIC_ASSET_MAX_AGE', 365 * 24 * 3600))
+
+# Instrumentación (apagada por defecto): tiempos por consulta y por request, /metrics y consultas lentas con su plan
+app.config['INSTRUMENTATION'] = os.getenv('INSTRUMENTATION', '0') == '1'
+app.config['SLOW_QUERY_MS'] = float(os.getenv('SLOW_QUERY_MS', 100))
+app.config['SLOW_QUERY_LOG_SIZE'] = int(os.getenv('SLOW_QUERY_LOG_SIZE', 100))
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+# Sólo si ningún proxy corre en la misma máquina: detrás de uno, todo pedido llega desde localhost
+app.config['METRICS_TRUST_LOCALHOST'] = os.getenv('METRICS_TRUST_LOCALHOST', '0') == '1'
+# Profiler por muestreo (lo activa el administrador): intervalo entre muestras y duración máxima
+app.config['PROFILER_INTERVAL'] = float(os.getenv('PROFILER_INTERVAL', 0.005))
+app.config['PROFILER_MAX_SECONDS'] = float(os.getenv('PROFILER_MAX_SECONDS', 300))
+
+# Catálogo normalizado: claves canónicas en memoria, sugerencias por trigramas y filas por lote del back-fill
+app.config['CATALOG_KEY_CACHE_SIZE'] = int(os.getenv('CATALOG_KEY_CACHE_SIZE', 65536))
+app.config['CATALOG_SUGGEST_LIMIT'] = int(os.getenv('CATALOG_SUGGEST_LIMIT', 5))
+app.config['CATALOG_SUGGEST_THRESHOLD'] = float(os.getenv('CATALOG_SUGGEST_THRESHOLD', 0.3))
+app.config['CATALOG_BACKFILL_BATCH_SIZE'] = int(os.getenv('CATALOG_BACKFILL_BATCH_SIZE', 5000))
+
+# Autocompletado: valores distintos por campo, largo máximo de cada valor, sugerencias por consulta,
+# claves recorridas por prefijo (y productos nuevos que se agregan sin reconstruir) y cada cuántos
+# segundos se reconstruye si cambiaron los datos
+app.config['AUTOCOMPLETE_MAX_VALUES'] = int(os.getenv('AUTOCOMPLETE_MAX_VALUES', 100000))
+app.config['AUTOCOMPLETE_MAX_LENGTH'] = int(os.getenv('AUTOCOMPLETE_MAX_LENGTH', 80))
+app.config['AUTOCOMPLETE_LIMIT'] = int(os.getenv('AUTOCOMPLETE_LIMIT', 10))
+app.config['AUTOCOMPLETE_SCAN_LIMIT'] = int(os.getenv('AUTOCOMPLETE_SCAN_LIMIT', 5000))
+app.config['AUTOCOMPLETE_REBUILD_SECONDS'] = float(os.getenv('AUTOCOMPLETE_REBUILD_SECONDS', 600))
+
 # Definir el usuario administrador desde una variable de entorno
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'tu_usuario')
 
@@ -27,27 +150,120 @@ login_manager.login_view = 'login'
 # Configurar la zona horaria de Argentina (UTC-3)
 argentina_tz = pytz.timezone('America/Argentina/Buenos_Aires')
 
+# Con gevent (el worker de gunicorn.conf.py) threading está parcheado: un Thread es una greenlet del mismo
+# hilo del sistema, y el trabajo largo (SQLite, reconstrucciones en Python) frena a todas las demás,
+# incluidos los streams del chat. Ese trabajo va al pool de hilos reales del hub de gevent.
+def gevent_threads_patched():
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+def start_background_task(target, *args):
+    if gevent_threads_patched():
+        import gevent
+        gevent.get_hub().threadpool.spawn(target, *args)
+    else:
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+# Ejecuta fn en un hilo real y espera sólo la greenlet del pedido; el contexto (app, request, g) viaja con la llamada
+def run_blocking(fn, *args):
+    if not gevent_threads_patched():
+        return fn(*args)
+    import gevent
+    return gevent.get_hub().threadpool.apply(contextvars.copy_context().run, (fn,) + args)
+
 # Procesador de contexto para pasar admin_username a todas las plantillas
 @app.context_processor
 def utility_processor():
     return dict(admin_username=ADMIN_USERNAME)
 
-# Modelo de usuario para Flask-Login
-class User(UserMixin):
+# Modelo de usuario para Flask-Login. UserMixin no declara __slots__ (cada instancia tendría __dict__
+# igual), así que los métodos que pide Flask-Login se definen acá
+class User:
+    __slots__ = ('id', 'username', 'email')
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
     def __init__(self, id, username, email):
         self.id = id
         self.username = username
         self.email = email
 
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, User):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+# Caché LRU con expiración de los usuarios cargados por Flask-Login
+class UserCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, user_id):
+        # Las entradas de una generación anterior del pool (base reemplazada) no son válidas
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                user, expires, generation = entry
+                if expires > time.monotonic() and generation == db_pool.generation:
+                    self.entries.move_to_end(user_id)
+                    self.counters['hits'] += 1
+                    return user
+                del self.entries[user_id]
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, user):
+        with self.lock:
+            self.entries[str(user.id)] = (user, time.monotonic() + self.ttl, db_pool.generation)
+            self.entries.move_to_end(str(user.id))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(str(user_id), None)
+            self.counters['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.counters['invalidations'] += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            hit_ratio = self.counters['hits'] / lookups if lookups else 0.0
+            return dict(self.counters, size=len(self.entries), hit_ratio=hit_ratio)
+
+user_cache = UserCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
 @login_manager.user_loader
 def load_user(user_id):
+    user = user_cache.get(str(user_id))
+    if user is not None:
+        return user
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
             c.execute('SELECT id, username, email FROM users WHERE id = ?', (user_id,))
             user = c.fetchone()
             if user:
-                return User(user[0], user[1], user[2])
+                user = User(user[0], user[1], user[2])
+                user_cache.put(user)
+                return user
             return None
     except sqlite3.Error as e:
         print(f"Error al cargar usuario: {e}")
@@ -58,98 +274,2276 @@ def load_user(user_id):
 def format_price(value):
     return "${:,.2f}".format(value).replace(',', 'X').replace('.', ',').replace('X', '.')
 
-# Conectar a la base de datos SQLite
-def get_db_connection():
-    try:
-        db_dir = os.path.dirname(DATABASE)
+# Cursor que reintenta las sentencias cuando la base está bloqueada por otro escritor
+class PooledCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return self._retry(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._retry(super().executemany, sql, seq_of_parameters)
+
+    def _retry(self, method, sql, parameters):
+        retries = app.config['DB_LOCK_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                return method(sql, parameters)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or attempt == retries or self.connection.in_transaction:
+                    raise
+                db_pool.count('lock_retries')
+                time.sleep(0.05 * (attempt + 1))
+
+# Métricas en memoria del worker, expuestas en formato Prometheus por /metrics
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self, gauges=()):
+        def fmt(labels):
+            if not labels:
+                return ''
+            values = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+            return '{' + values + '}'
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{name}{fmt(labels)} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append(f'{name}_bucket{fmt(labels + (("le", bound),))} {count}')
+                lines.append(f'{name}_bucket{fmt(labels + (("le", "+Inf"),))} {histogram[-1]}')
+                lines.append(f'{name}_sum{fmt(labels)} {histogram[-2]}')
+                lines.append(f'{name}_count{fmt(labels)} {histogram[-1]}')
+        for name, value in gauges:
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics((0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+slow_queries = deque(maxlen=app.config['SLOW_QUERY_LOG_SIZE'])
+
+def statement_kind(sql):
+    words = sql.lstrip().split(None, 1)
+    return words[0].upper() if words else ''
+
+# Consultas lentas: se guardan con su plan (EXPLAIN QUERY PLAN) para ver qué índice usan
+def record_slow_query(conn, query):
+    plan = None
+    if statement_kind(query['sql']) in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+        try:
+            c = conn.cursor(PooledCursor)
+            c.execute('EXPLAIN QUERY PLAN ' + query['sql'], query['parameters'] or ())
+            plan = [row[3] for row in c.fetchall()]
+        except sqlite3.Error as e:
+            plan = [f'No se pudo obtener el plan: {e}']
+    entry = {
+        'sql': ' '.join(query['sql'].split()),
+        'ms': round(query['seconds'] * 1000, 2),
+        'rows': query['rows'],
+        'plan': plan,
+        'endpoint': request.endpoint if has_request_context() else None,
+        'at': datetime.now(argentina_tz).strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    slow_queries.append(entry)
+    metrics.inc('app_sql_slow_queries_total', (('statement', statement_kind(query['sql'])),))
+    return entry
+
+# Cursor instrumentado (sólo con INSTRUMENTATION=1): cada sentencia se cuenta y se mide al volver de
+# execute, así que también quedan registradas las que se leen con fetchone o se dejan a medias. El tiempo
+# de leer filas se suma aparte (app_sql_fetch_seconds_total) cuando el cursor se reutiliza, se agota, se
+# cierra o se libera. Medir cada fila cuesta: iterar 100k filas tarda unas 2,4 veces más que sin instrumentar.
+class InstrumentedCursor(PooledCursor):
+    query = None
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._begin(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._begin(sql, None, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._add(time.perf_counter() - start, 0 if row is None else 1)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._add(time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._add(time.perf_counter() - start, len(rows))
+        self._finish()
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._add(time.perf_counter() - start, 0)
+            self._finish()
+            raise
+        self._add(time.perf_counter() - start, 1)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+    def _begin(self, sql, parameters, elapsed):
+        kind = statement_kind(sql)
+        self.query = {'sql': sql, 'parameters': parameters, 'kind': kind, 'seconds': 0.0, 'fetch_seconds': 0.0,
+                      'rows': 0, 'slow': None}
+        metrics.inc('app_sql_queries_total', (('statement', kind),))
+        metrics.observe('app_sql_query_duration_seconds', (('statement', kind),), elapsed)
+        timing = g.get('request_timing') if has_app_context() else None
+        if timing is not None:
+            timing['queries'] += 1
+        self._track(elapsed, max(self.rowcount, 0))
+
+    def _add(self, elapsed, rows):
+        query = self.query
+        if query is not None:
+            query['fetch_seconds'] += elapsed
+            self._track(elapsed, rows)
+
+    def _track(self, elapsed, rows):
+        query = self.query
+        query['seconds'] += elapsed
+        query['rows'] += rows
+        timing = g.get('request_timing') if has_app_context() else None
+        if timing is not None:
+            timing['db'] += elapsed
+        if query['seconds'] * 1000 >= app.config['SLOW_QUERY_MS']:
+            if query['slow'] is None:
+                query['slow'] = record_slow_query(self.connection, query)
+            else:
+                query['slow'].update(ms=round(query['seconds'] * 1000, 2), rows=query['rows'])
+
+    def _finish(self):
+        query = self.query
+        if query is not None:
+            self.query = None
+            if query['fetch_seconds']:
+                metrics.inc('app_sql_fetch_seconds_total', (('statement', query['kind']),), query['fetch_seconds'])
+
+# Conexión del pool: recuerda la generación del archivo con la que fue abierta
+class PooledConnection(sqlite3.Connection):
+    generation = 0
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = InstrumentedCursor if app.config['INSTRUMENTATION'] else PooledCursor
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+# Pool de conexiones por worker; cada request toma una conexión y la devuelve al terminar
+class ConnectionPool:
+    def __init__(self, database, max_size):
+        self.database = database
+        self.max_size = max_size
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.generation = 0
+        self.file_id = None
+        self.last_stat = 0.0
+        self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'lock_retries': 0, 'reconnects': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, opened=self.opened, idle=self.idle.qsize(), generation=self.generation)
+
+    def _file_id(self):
+        # Identidad del archivo más la marca que deja upload_db al reemplazar el contenido
+        try:
+            st = os.stat(self.database)
+        except OSError:
+            return None
+        try:
+            swapped = os.stat(self.database + '-swap').st_mtime_ns
+        except OSError:
+            swapped = None
+        return (st.st_dev, st.st_ino, swapped)
+
+    def _check_file(self):
+        # Detecta si otro proceso reemplazó la base (por ejemplo, upload_db en otro worker)
+        now = time.monotonic()
+        if now - self.last_stat < app.config['DB_STAT_INTERVAL']:
+            return
+        self.last_stat = now
+        file_id = self._file_id()
+        if self.file_id is not None and file_id != self.file_id:
+            self.reset()
+        self.file_id = file_id
+
+    def _connect(self):
+        db_dir = os.path.dirname(self.database)
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir)
-        conn = sqlite3.connect(DATABASE)
+        conn = sqlite3.connect(self.database, factory=PooledConnection, check_same_thread=False,
+                               timeout=app.config['DB_BUSY_TIMEOUT_MS'] / 1000)
+        conn.generation = self.generation
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f"PRAGMA busy_timeout={app.config['DB_BUSY_TIMEOUT_MS']}")
+        conn.execute(f"PRAGMA mmap_size={app.config['DB_MMAP_SIZE']}")
+        conn.execute(f"PRAGMA cache_size=-{app.config['DB_CACHE_SIZE_KB']}")
+        if self.file_id is None:
+            self.file_id = self._file_id()
         return conn
+
+    def _discard(self, conn):
+        with self.lock:
+            self.opened -= 1
+        conn.close()
+
+    def acquire(self):
+        self._check_file()
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if conn.generation == self.generation:
+                self.count('hits')
+                return conn
+            self._discard(conn)
+        with self.lock:
+            can_open = self.opened < self.max_size
+            if can_open:
+                self.opened += 1
+                self.counters['misses'] += 1
+        if can_open:
+            try:
+                return self._connect()
+            except sqlite3.Error:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        # Pool agotado: se espera a que otro request devuelva su conexión
+        self.count('waits')
+        try:
+            conn = self.idle.get(timeout=app.config['DB_POOL_TIMEOUT'])
+        except queue.Empty:
+            raise sqlite3.OperationalError('No hay conexiones disponibles en el pool')
+        if conn.generation != self.generation:
+            self._discard(conn)
+            return self.acquire()
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if conn.generation != self.generation:
+            self._discard(conn)
+        else:
+            self.idle.put(conn)
+
+    def reset(self):
+        # Cierra las conexiones ociosas; las que están en uso se cierran al devolverse
+        with self.lock:
+            self.generation += 1
+            self.counters['reconnects'] += 1
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+        self.file_id = None
+
+db_pool = ConnectionPool(DATABASE, app.config['DB_POOL_SIZE'])
+
+# Conectar a la base de datos SQLite (una conexión del pool por request)
+def get_db_connection():
+    try:
+        if not has_app_context():
+            return db_pool._connect()
+        if 'db_conn' not in g:
+            g.db_conn = db_pool.acquire()
+        return g.db_conn
     except sqlite3.Error as e:
         print(f"Error al conectar a la base de datos: {e}")
         raise e
 
+# Devolver la conexión al pool al terminar el request
+@app.teardown_appcontext
+def release_db_connection(exception):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+# Cerrar todas las conexiones (por ejemplo, después de reemplazar el archivo de la base)
+def reset_db_connections():
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        # Vuelca el WAL al archivo principal antes de que el archivo sea reemplazado
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        db_pool._discard(conn)
+    db_pool.reset()
+    user_cache.clear()
+    response_cache.clear()
+
 # Obtener la fecha actual en la zona horaria de Argentina
 def get_current_time():
     return datetime.now(argentina_tz).strftime('%Y-%m-%d %H:%M:%S')
 
-# Convertir timestamp a la zona horaria de Argentina
-def to_argentina_time(timestamp):
+# Fecha local y epoch UTC del mismo instante: el texto se conserva, el entero se usa para ordenar
+def get_current_timestamp():
+    now = datetime.now(argentina_tz)
+    return now.strftime('%Y-%m-%d %H:%M:%S'), int(now.timestamp())
+
+# Expresión SQL que pasa una fecha local guardada como texto a epoch UTC (0 si no se puede leer).
+# Argentina no usa horario de verano desde 2009, así que el desfasaje es fijo.
+ARGENTINA_UTC_OFFSET = 3 * 3600
+
+def epoch_sql(column):
+    return f"COALESCE(CAST(strftime('%s', {column}) AS INTEGER) + {ARGENTINA_UTC_OFFSET}, 0)"
+
+# Formatear un epoch para mostrarlo: sólo se llama para las filas que se renderizan, y se memoriza
+@app.template_filter('format_timestamp')
+@functools.lru_cache(maxsize=app.config['TIMESTAMP_CACHE_SIZE'])
+def format_timestamp(epoch):
+    if not epoch:
+        return ''
+    return datetime.fromtimestamp(epoch, argentina_tz).strftime('%Y-%m-%d %H:%M:%S')
+
+# Cursores de paginación: codifican la clave (upload_ts, id) de una fila
+def encode_cursor(upload_ts, product_id):
+    raw = f'{upload_ts}|{product_id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
     try:
-        dt = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-        dt = argentina_tz.localize(dt)
-        return dt.strftime('%Y-%m-%d %H:%M:%S')
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        upload_ts, product_id = raw.rsplit('|', 1)
+        return int(upload_ts), int(product_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+# Tamaño de página pedido por query string, acotado por la configuración
+def get_page_size():
+    default = app.config['PRODUCTS_PAGE_SIZE']
+    try:
+        page_size = int(request.args.get('page_size', default))
     except ValueError:
-        return timestamp
+        page_size = default
+    return max(1, min(page_size, app.config['PRODUCTS_MAX_PAGE_SIZE']))
+
+def use_streaming():
+    stream = request.args.get('stream')
+    if stream is not None:
+        return stream == '1'
+    return app.config['STREAM_TEMPLATES']
+
+# Página de productos con paginación por cursor (keyset sobre upload_ts, product_id)
+class ProductPage:
+    def __init__(self, conn, page_size, after=None, before=None):
+        self.conn = conn
+        self.page_size = page_size
+        self.after = decode_cursor(after)
+        self.before = decode_cursor(before) if not self.after else None
+        self.next_cursor = None
+        self.prev_cursor = None
+        self._rows = None
+
+    def _query(self):
+        # Se lee la tabla resumida latest_prices: un producto por lugar con su último precio
+        columns = 'SELECT product_id, name, brand, price, place, upload_ts, user_id FROM latest_prices'
+        if self.before:
+            # Página anterior: se recorre en orden ascendente y luego se invierte
+            return (f'{columns} WHERE (upload_ts, product_id) > (?, ?) '
+                    'ORDER BY upload_ts ASC, product_id ASC LIMIT ?',
+                    (*self.before, self.page_size + 1))
+        if self.after:
+            return (f'{columns} WHERE (upload_ts, product_id) < (?, ?) '
+                    'ORDER BY upload_ts DESC, product_id DESC LIMIT ?',
+                    (*self.after, self.page_size + 1))
+        return (f'{columns} ORDER BY upload_ts DESC, product_id DESC LIMIT ?', (self.page_size + 1,))
+
+    def _iter_rows(self):
+        query, params = self._query()
+        c = self.conn.cursor()
+        c.execute(query, params)
+        if self.before:
+            rows = c.fetchall()
+            has_more = len(rows) > self.page_size
+            rows = rows[:self.page_size][::-1]
+            if rows:
+                self.next_cursor = encode_cursor(rows[-1][5], rows[-1][0])
+                if has_more:
+                    self.prev_cursor = encode_cursor(rows[0][5], rows[0][0])
+            yield from rows
+            return
+        first = last = None
+        count = 0
+        for row in c:
+            if count == self.page_size:
+                self.next_cursor = encode_cursor(last[5], last[0])
+                break
+            if first is None:
+                first = row
+            last = row
+            count += 1
+            yield row
+        if self.after and first is not None:
+            self.prev_cursor = encode_cursor(first[5], first[0])
+
+    def __iter__(self):
+        if self._rows is not None:
+            yield from self._rows
+            return
+        # La fecha queda como epoch: la plantilla la formatea sólo al mostrarla
+        yield from self._iter_rows()
+
+    def fetch(self):
+        self._rows = list(self)
+        return self
+
+# Convierte el texto de búsqueda en una consulta FTS5 por prefijo (todas las palabras deben aparecer)
+def build_fts_query(search_query):
+    terms = [t.replace('"', '') for t in search_query.split()]
+    return ' '.join(f'"{t}"*' for t in terms if t)
+
+# Búsqueda de texto completo sobre nombre, marca y lugar, ordenada por BM25
+def search_products(conn, search_query, limit):
+    fts_query = build_fts_query(search_query)
+    if not fts_query:
+        return []
+    c = conn.cursor()
+    # Sólo se devuelven los reportes vigentes (el último precio de cada producto por lugar)
+    c.execute('''SELECT lp.product_id, lp.name, lp.brand, lp.price, lp.place, lp.upload_ts, lp.user_id
+                 FROM products_fts
+                 JOIN latest_prices lp ON lp.product_id = products_fts.rowid
+                 WHERE products_fts MATCH ?
+                 ORDER BY products_fts.rank
+                 LIMIT ?''', (fts_query, limit))
+    return c.fetchall()
+
+# Catálogo normalizado: el mismo producto o lugar escrito de distintas formas ("Coca Cola 2L",
+# "coca-cola 2 l", "COCA COLA 2lt") comparte una clave canónica y un id en catalog_products/stores
+CATALOG_UNITS = {
+    'ml': ('ml', 'cc', 'cm3'),
+    'l': ('l', 'lt', 'lts', 'ltr', 'litro', 'litros'),
+    'g': ('g', 'gr', 'grs', 'gramo', 'gramos'),
+    'kg': ('kg', 'kgs', 'kilo', 'kilos'),
+    'u': ('u', 'un', 'unid', 'unidad', 'unidades'),
+}
+CATALOG_UNIT_ALIASES = {alias: unit for unit, aliases in CATALOG_UNITS.items() for alias in aliases}
+CATALOG_QUANTITY_RE = re.compile(r'(\d+(?:[.,]\d+)?)\s*('
+                                 + '|'.join(sorted(CATALOG_UNIT_ALIASES, key=len, reverse=True)) + r')\b')
+CATALOG_APOSTROPHE_RE = re.compile(r"['’`´]")
+# Todo lo que no es letra, número o punto decimal separa palabras
+CATALOG_SEPARATOR_RE = re.compile(r'(?<!\d)\.|\.(?!\d)|[^a-z0-9.]+')
+# Tabla del catálogo -> (columnas que se muestran, tabla de trigramas, columna en products)
+CATALOG_TABLES = {
+    'catalog_products': (('name', 'brand'), 'catalog_trigrams', 'catalog_product_id'),
+    'stores': (('name',), 'store_trigrams', 'store_id'),
+}
+
+# Las cantidades pasan a la unidad menor (2 lt -> 2000ml, 1,5 kg -> 1500g): así 500 ml y 0,5 l coinciden
+def fold_quantity(match):
+    value = float(match.group(1).replace(',', '.'))
+    unit = CATALOG_UNIT_ALIASES[match.group(2)]
+    if unit in ('l', 'kg'):
+        value *= 1000
+        unit = 'ml' if unit == 'l' else 'g'
+    return ('%.3f' % value).rstrip('0').rstrip('.') + unit
+
+# Clave canónica: minúsculas, sin acentos ni signos, unidades unificadas y espacios simples
+@functools.lru_cache(maxsize=app.config['CATALOG_KEY_CACHE_SIZE'])
+def canonical_key(text):
+    text = CATALOG_APOSTROPHE_RE.sub('', str(text).lower())
+    if not text.isascii():
+        text = ''.join(ch for ch in unicodedata.normalize('NFKD', text) if not unicodedata.combining(ch))
+    text = CATALOG_QUANTITY_RE.sub(fold_quantity, text)
+    return ' '.join(CATALOG_SEPARATOR_RE.sub(' ', text).split())
+
+def catalog_key(name, brand):
+    return f'{canonical_key(name)}|{canonical_key(brand)}'
+
+# Trigramas de cada palabra con relleno de espacios (como pg_trgm): "cola" -> "  c", " co", "col", "ola", "la "
+def trigrams(key):
+    grams = set()
+    for word in key.replace('|', ' ').split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+# Ids de las claves pedidas ({clave: valores a mostrar}); las que no existen se crean con sus trigramas.
+# OR IGNORE: otro worker puede crear la misma clave entre la búsqueda y la inserción.
+def add_catalog_entries(c, table, entries):
+    columns, trigram_table, id_column = CATALOG_TABLES[table]
+
+    def find_ids(keys):
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            c.execute(f"SELECT canonical_key, id FROM {table} WHERE canonical_key IN ({','.join('?' * len(chunk))})", chunk)
+            ids.update(c.fetchall())
+
+    ids = {}
+    find_ids(list(entries))
+    missing = {key: trigrams(key) for key in entries if key not in ids}
+    if missing:
+        c.executemany(f"INSERT OR IGNORE INTO {table} (canonical_key, {', '.join(columns)}, trigram_count) "
+                      f"VALUES (?, {', '.join('?' * len(columns))}, ?)",
+                      [(key, *entries[key], len(grams)) for key, grams in missing.items()])
+        find_ids(list(missing))
+        # Ordenados por la clave primaria, los trigramas se agregan al índice sin saltar de página en página
+        c.executemany(f'INSERT OR IGNORE INTO {trigram_table} (trigram, {id_column}) VALUES (?, ?)',
+                      sorted((gram, ids[key]) for key, grams in missing.items() for gram in grams))
+    return ids
+
+# (catalog_product_id, store_id) de cada (name, brand, place), para guardarlos junto con el producto
+def catalog_ids(conn, products):
+    product_keys = {}
+    store_keys = {}
+    for name, brand, place in products:
+        if (name, brand) not in product_keys:
+            product_keys[(name, brand)] = catalog_key(name, brand)
+        if place not in store_keys:
+            store_keys[place] = canonical_key(place)
+    c = conn.cursor()
+    ids_by_text = {}
+    for table, keys in (('catalog_products', product_keys), ('stores', store_keys)):
+        entries = {}
+        for text, key in keys.items():
+            entries.setdefault(key, text if table == 'catalog_products' else (text,))
+        ids = add_catalog_entries(c, table, entries)
+        ids_by_text[table] = {text: ids[key] for text, key in keys.items()}
+    return [(ids_by_text['catalog_products'][(name, brand)], ids_by_text['stores'][place])
+            for name, brand, place in products]
+
+# Completa catalog_product_id y store_id de los productos entre first_id y last_id que no los tienen
+def link_catalog(conn, first_id, last_id=None):
+    last_id = sys.maxsize if last_id is None else last_id
+    c = conn.cursor()
+    c.execute('''SELECT DISTINCT name, brand, place FROM products
+                 WHERE id BETWEEN ? AND ? AND catalog_product_id IS NULL''', (first_id, last_id))
+    rows = c.fetchall()
+    if not rows:
+        return 0
+    catalog_ids(conn, rows)
+    # La clave se calcula en SQL con las mismas funciones (memorizadas) para buscar por el índice único
+    conn.create_function('catalog_key', 2, catalog_key, deterministic=True)
+    conn.create_function('canonical_key', 1, canonical_key, deterministic=True)
+    c.execute('''UPDATE products SET
+                     catalog_product_id = (SELECT id FROM catalog_products
+                                           WHERE canonical_key = catalog_key(products.name, products.brand)),
+                     store_id = (SELECT id FROM stores WHERE canonical_key = canonical_key(products.place))
+                 WHERE id BETWEEN ? AND ? AND catalog_product_id IS NULL''', (first_id, last_id))
+    linked = c.rowcount
+    # Las filas de latest_prices que apuntan a esos productos toman los mismos ids
+    c.execute('''UPDATE latest_prices SET (catalog_product_id, store_id) =
+                     (SELECT catalog_product_id, store_id FROM products WHERE id = latest_prices.product_id)
+                 WHERE catalog_product_id IS NULL''')
+    return linked
+
+# Back-fill por lotes de las claves del catálogo en los productos sin vincular, una transacción por lote.
+# BEGIN IMMEDIATE toma la escritura antes de leer: el lote no choca con otro worker a mitad de camino.
+def backfill_catalog(conn, batch_size):
+    c = conn.cursor()
+    c.execute('SELECT MIN(id), MAX(id) FROM products WHERE catalog_product_id IS NULL')
+    first_id, last_id = c.fetchone()
+    linked = 0
+    if first_id is None:
+        return linked
+    for start in range(first_id, last_id + 1, batch_size):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            linked += link_catalog(conn, start, start + batch_size - 1)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return linked
+
+# Vinculador en segundo plano: las importaciones, fusiones y bases subidas guardan los productos sin ids del
+# catálogo (calcularlos en línea triplicaba el tiempo de importación) y este hilo los completa por lotes.
+# Uno solo por worker; si llegan productos mientras corre, da otra vuelta al terminar.
+catalog_link_lock = threading.Lock()
+catalog_link_state = {'running': False, 'pending': False}
+
+def schedule_catalog_link():
+    with catalog_link_lock:
+        if catalog_link_state['running']:
+            catalog_link_state['pending'] = True
+            return
+        catalog_link_state['running'] = True
+    start_background_task(link_catalog_in_background)
+
+def link_catalog_in_background():
+    while True:
+        try:
+            with app.app_context():
+                with get_db_connection() as conn:
+                    backfill_catalog(conn, app.config['CATALOG_BACKFILL_BATCH_SIZE'])
+        except sqlite3.Error as e:
+            print(f"Error al vincular productos con el catálogo: {e}")
+        with catalog_link_lock:
+            if not catalog_link_state['pending']:
+                catalog_link_state['running'] = False
+                return
+            catalog_link_state['pending'] = False
+
+# Entradas del catálogo parecidas a un texto. Se ordenan por la parte de los trigramas del texto que
+# aparece en la entrada (lo escrito suele ser sólo una parte: el nombre sin la marca) y, a igualdad, por
+# la similitud de Jaccard, que prefiere la entrada más parecida en largo
+def catalog_suggestions(conn, table, text, limit, threshold):
+    grams = sorted(trigrams(canonical_key(text)))
+    if not grams:
+        return []
+    columns, trigram_table, id_column = CATALOG_TABLES[table]
+    c = conn.cursor()
+    c.execute(f'''SELECT e.id, {', '.join('e.' + column for column in columns)}, m.shared * 1.0 / ? AS similarity
+                  FROM (SELECT {id_column} AS id, COUNT(*) AS shared FROM {trigram_table}
+                        WHERE trigram IN ({','.join('?' * len(grams))})
+                        GROUP BY {id_column}) m
+                  JOIN {table} e ON e.id = m.id
+                  WHERE m.shared >= ?
+                  ORDER BY m.shared DESC, m.shared * 1.0 / (? + e.trigram_count - m.shared) DESC, e.id
+                  LIMIT ?''', (len(grams), *grams, threshold * len(grams), len(grams), limit))
+    return [dict(zip(('id', *columns, 'similarity'), (*row[:-1], round(row[-1], 3)))) for row in c.fetchall()]
+
+# Autocompletado de nombre, marca y lugar. Por campo se guarda un arreglo ordenado de claves canónicas
+# (las que empiezan con un prefijo quedan contiguas y se ubican con bisect) y, por clave, el valor a
+# mostrar y cuántos productos lo usan. Los prefijos de 1 o 2 letras abarcan demasiadas claves: sus
+# valores más populares se guardan de antemano.
+AUTOCOMPLETE_FIELDS = ('name', 'brand', 'place')
+# Bytes aproximados de cada entrada además de los textos: el puntero del arreglo y dos entradas de dict
+AUTOCOMPLETE_ENTRY_OVERHEAD = 8 + 2 * 48
+
+class AutocompleteIndex:
+    def __init__(self, max_values, max_length, limit, scan_limit, rebuild_seconds):
+        self.max_values = max_values
+        self.max_length = max_length
+        self.limit = limit
+        self.scan_limit = scan_limit
+        self.rebuild_seconds = rebuild_seconds
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.fields = {field: self.new_field() for field in AUTOCOMPLETE_FIELDS}
+        self.version = None
+        self.last_id = 0
+        self.built_at = 0
+        self.rebuilds = 0
+
+    @staticmethod
+    def new_field():
+        return {'keys': [], 'values': {}, 'counts': {}, 'top': {}, 'bytes': 0}
+
+    def entry_bytes(self, key, value):
+        return sys.getsizeof(key) + sys.getsizeof(value) + AUTOCOMPLETE_ENTRY_OVERHEAD
+
+    def fill_top(self, data):
+        candidates = {}
+        for key, count in data['counts'].items():
+            for size in (1, 2):
+                if len(key) >= size:
+                    candidates.setdefault(key[:size], []).append((count, key))
+        data['top'] = {prefix: [key for _, key in heapq.nlargest(self.limit, items)]
+                       for prefix, items in candidates.items()}
+
+    # Al cambiar la cantidad de una clave se reubica en las listas de sus prefijos cortos
+    def update_top(self, data, key):
+        counts = data['counts']
+        for size in (1, 2):
+            if len(key) < size:
+                continue
+            top = data['top'].setdefault(key[:size], [])
+            if key in top:
+                top.remove(key)
+            if key in counts:
+                top.append(key)
+                top.sort(key=counts.__getitem__, reverse=True)
+                del top[self.limit:]
+
+    # Índice completo desde products; se arma fuera del lock y se reemplaza de una vez
+    def build(self, conn):
+        c = conn.cursor()
+        version = get_data_version(conn)
+        c.execute('SELECT COALESCE(MAX(id), 0) FROM products')
+        last_id = c.fetchone()[0]
+        fields = {}
+        for field in AUTOCOMPLETE_FIELDS:
+            c.execute(f'SELECT {field}, COUNT(*) FROM products WHERE id <= ? GROUP BY {field}', (last_id,))
+            values = {}
+            counts = {}
+            spellings = {}
+            for value, count in c.fetchall():
+                key = canonical_key(value)[:self.max_length]
+                if not key:
+                    continue
+                counts[key] = counts.get(key, 0) + count
+                # Se muestra la forma más usada de escribir el valor
+                if count > spellings.get(key, 0):
+                    values[key] = value[:self.max_length]
+                    spellings[key] = count
+            if len(counts) > self.max_values:
+                counts = dict(heapq.nlargest(self.max_values, counts.items(), key=lambda item: item[1]))
+                values = {key: values[key] for key in counts}
+            data = self.new_field()
+            data['keys'] = sorted(counts)
+            data['values'] = values
+            data['counts'] = counts
+            data['bytes'] = sum(self.entry_bytes(key, value) for key, value in values.items())
+            self.fill_top(data)
+            fields[field] = data
+        with self.lock:
+            self.fields = fields
+            self.version = version
+            self.last_id = last_id
+            self.built_at = time.monotonic()
+            self.rebuilds += 1
+
+    def add(self, field, value, delta):
+        data = self.fields[field]
+        key = canonical_key(value)[:self.max_length]
+        if not key:
+            return
+        counts = data['counts']
+        if key not in counts:
+            # Lleno: los valores nuevos (los menos usados) esperan a la próxima reconstrucción
+            if delta <= 0 or len(counts) >= self.max_values:
+                return
+            counts[key] = 0
+            data['values'][key] = value[:self.max_length]
+            bisect.insort(data['keys'], key)
+            data['bytes'] += self.entry_bytes(key, data['values'][key])
+        counts[key] += delta
+        if counts[key] <= 0:
+            del counts[key]
+            data['bytes'] -= self.entry_bytes(key, data['values'].pop(key))
+            del data['keys'][bisect.bisect_left(data['keys'], key)]
+        self.update_top(data, key)
+
+    # Pone el índice al día. Si se reemplazó la base, pasó rebuild_seconds o entraron muchos productos
+    # juntos (una importación) se reconstruye en segundo plano y mientras tanto se responde con el índice
+    # actual; si no, sólo se agregan los productos nuevos (por id). Las ediciones hechas en otros workers
+    # se ven al reconstruir.
+    def refresh(self, conn):
+        version = get_data_version(conn)
+        if version == self.version:
+            return
+        if self.version is None:
+            with self.refresh_lock:
+                if self.version is None:
+                    self.build(conn)
+            return
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        rebuilding = False
+        try:
+            if self.version == version:
+                return
+            stale = version[0] != self.version[0] or time.monotonic() - self.built_at > self.rebuild_seconds
+            if not stale:
+                c = conn.cursor()
+                c.execute('SELECT id, name, brand, place FROM products WHERE id > ? ORDER BY id LIMIT ?',
+                          (self.last_id, self.scan_limit + 1))
+                rows = c.fetchall()
+                stale = len(rows) > self.scan_limit
+            if stale:
+                rebuilding = True
+                start_background_task(self.rebuild_in_background)
+                return
+            with self.lock:
+                for row in rows:
+                    for field, value in zip(AUTOCOMPLETE_FIELDS, row[1:]):
+                        self.add(field, value, 1)
+                if rows:
+                    self.last_id = rows[-1][0]
+                self.version = version
+        finally:
+            # El hilo de la reconstrucción libera el lock al terminar
+            if not rebuilding:
+                self.refresh_lock.release()
+
+    def rebuild_in_background(self):
+        try:
+            with app.app_context():
+                with get_db_connection() as conn:
+                    self.build(conn)
+        except sqlite3.Error as e:
+            print(f"Error al reconstruir el autocompletado: {e}")
+        finally:
+            self.refresh_lock.release()
+
+    # Edición de un producto en este worker: (name, brand, place) viejos y nuevos
+    def replace(self, old, new):
+        with self.lock:
+            for field, old_value, new_value in zip(AUTOCOMPLETE_FIELDS, old, new):
+                if old_value != new_value:
+                    self.add(field, old_value, -1)
+                    self.add(field, new_value, 1)
+
+    def search(self, field, prefix, limit):
+        key = canonical_key(prefix)[:self.max_length]
+        if not key:
+            return []
+        limit = min(limit, self.limit)
+        with self.lock:
+            data = self.fields[field]
+            counts = data['counts']
+            if len(key) <= 2:
+                keys = data['top'].get(key, [])[:limit]
+            else:
+                sorted_keys = data['keys']
+                start = bisect.bisect_left(sorted_keys, key)
+                end = min(len(sorted_keys), start + self.scan_limit)
+                end = bisect.bisect_left(sorted_keys, key + '\uffff', start, end)
+                keys = heapq.nlargest(limit, sorted_keys[start:end], key=counts.__getitem__)
+            return [{'value': data['values'][k], 'count': counts[k]} for k in keys]
+
+    def stats(self):
+        with self.lock:
+            stats = {'rebuilds': self.rebuilds, 'last_id': self.last_id,
+                     'max_values': self.max_values, 'values': 0, 'bytes': 0}
+            for field, data in self.fields.items():
+                stats[f'{field}_values'] = len(data['counts'])
+                stats[f'{field}_bytes'] = data['bytes']
+                stats['values'] += len(data['counts'])
+                stats['bytes'] += data['bytes']
+        return stats
+
+autocomplete = AutocompleteIndex(app.config['AUTOCOMPLETE_MAX_VALUES'], app.config['AUTOCOMPLETE_MAX_LENGTH'],
+                                 app.config['AUTOCOMPLETE_LIMIT'], app.config['AUTOCOMPLETE_SCAN_LIMIT'],
+                                 app.config['AUTOCOMPLETE_REBUILD_SECONDS'])
+
+# Arma el índice de autocompletado al arrancar, en segundo plano para no demorar el inicio del worker
+def warm_autocomplete():
+    try:
+        with app.app_context():
+            with get_db_connection() as conn:
+                autocomplete.refresh(conn)
+    except sqlite3.Error as e:
+        print(f"Error al armar el autocompletado: {e}")
+
+# Comparación de precios: último precio de un producto en cada lugar. latest_prices guarda los ids del
+# catálogo, así que todas las variantes del nombre y del lugar se unen leyendo sólo la fila vigente de
+# cada una; las filas que todavía no están vinculadas se suman por nombre + marca.
+def compare_prices(conn, name, brand):
+    c = conn.cursor()
+    c.execute('''SELECT s.canonical_key, s.name, lp.price, lp.upload_ts, lp.product_id
+                 FROM catalog_products cp
+                 JOIN latest_prices lp ON lp.catalog_product_id = cp.id
+                 JOIN stores s ON s.id = lp.store_id
+                 WHERE cp.canonical_key = ?''', (catalog_key(name, brand),))
+    found = c.fetchall()
+    c.execute('''SELECT place, place, price, upload_ts, product_id FROM latest_prices
+                 WHERE name = ? AND brand = ? AND (catalog_product_id IS NULL OR store_id IS NULL)''', (name, brand))
+    found += [(canonical_key(row[0]),) + row[1:] for row in c.fetchall()]
+    # Varias variantes en el mismo lugar: vale el reporte más reciente
+    latest = {}
+    for store_key, place, price, upload_ts, product_id in found:
+        if store_key not in latest or (upload_ts, product_id) > latest[store_key][0]:
+            latest[store_key] = ((upload_ts, product_id), (place, price, upload_ts))
+    rows = sorted((row for _, row in latest.values()), key=lambda row: (row[1], row[0]))
+    if not rows:
+        return None
+    # Las filas ya vienen ordenadas por precio: la mediana sale de las posiciones centrales
+    middle = len(rows) // 2
+    if len(rows) % 2:
+        median_price = rows[middle][1]
+    else:
+        median_price = (rows[middle - 1][1] + rows[middle][1]) / 2
+    return {
+        'prices': rows,
+        'min_price': rows[0][1],
+        'max_price': rows[-1][1],
+        'median_price': median_price,
+        'places': len(rows),
+        'cheapest_place': rows[0][0],
+    }
+
+# Renderiza un listado paginado, en streaming o de una sola vez
+def render_product_page(template, **context):
+    page_size = get_page_size()
+    after = request.args.get('after')
+    before = request.args.get('before')
+    if use_streaming():
+        # stream_template mantiene el contexto vivo: la conexión vuelve al pool al terminar el streaming
+        page = ProductPage(get_db_connection(), page_size, after, before)
+        return app.response_class(stream_template(template, products=page, **context))
+    with get_db_connection() as conn:
+        page = ProductPage(conn, page_size, after, before).fetch()
+    return render_template(template, products=page, **context)
+
+# Recalcula en latest_prices la fila de un producto/lugar a partir del historial (usado en triggers)
+def refresh_latest_price_sql(row):
+    return f'''DELETE FROM latest_prices WHERE name = {row}.name AND brand = {row}.brand AND place = {row}.place;
+                INSERT INTO latest_prices (name, brand, place, product_id, price, upload_date, upload_ts, user_id)
+                SELECT name, brand, place, id, price, upload_date, upload_ts, user_id FROM products
+                WHERE name = {row}.name COLLATE NOCASE AND brand = {row}.brand COLLATE NOCASE AND place = {row}.place
+                ORDER BY upload_ts DESC, id DESC LIMIT 1;'''
+
+# Reconstruye la tabla latest_prices completa desde products
+def rebuild_latest_prices(conn):
+    c = conn.cursor()
+    c.execute('DELETE FROM latest_prices')
+    c.execute('''INSERT INTO latest_prices (name, brand, place, product_id, price, upload_date, upload_ts, user_id)
+                 SELECT name, brand, place, id, price, upload_date, upload_ts, user_id FROM (
+                     SELECT id, name, brand, place, price, upload_date, upload_ts, user_id,
+                            ROW_NUMBER() OVER (
+                                PARTITION BY name COLLATE NOCASE, brand COLLATE NOCASE, place
+                                ORDER BY upload_ts DESC, id DESC
+                            ) AS rn
+                     FROM products
+                 ) WHERE rn = 1''')
+
+# Indexar en bloque (FTS y latest_prices) los productos insertados después de after_id
+def index_new_products(conn, after_id):
+    c = conn.cursor()
+    c.execute('''INSERT INTO products_fts (rowid, name, brand, place)
+                 SELECT id, name, brand, place FROM products WHERE id > ?''', (after_id,))
+    # Los ids del catálogo sólo dependen del texto: una fila que ya existe los conserva
+    c.execute('''INSERT INTO latest_prices (name, brand, place, product_id, price, upload_date, upload_ts, user_id,
+                                           catalog_product_id, store_id)
+                 SELECT name, brand, place, id, price, upload_date, upload_ts, user_id, catalog_product_id, store_id FROM (
+                     SELECT id, name, brand, place, price, upload_date, upload_ts, user_id, catalog_product_id, store_id,
+                            ROW_NUMBER() OVER (
+                                PARTITION BY name COLLATE NOCASE, brand COLLATE NOCASE, place
+                                ORDER BY upload_ts DESC, id DESC
+                            ) AS rn
+                     FROM products
+                     WHERE id > ?
+                 ) WHERE rn = 1
+                 ON CONFLICT (name, brand, place) DO UPDATE SET
+                     name = excluded.name, brand = excluded.brand, product_id = excluded.product_id,
+                     price = excluded.price, upload_date = excluded.upload_date, upload_ts = excluded.upload_ts,
+                     user_id = excluded.user_id
+                 WHERE (excluded.upload_ts, excluded.product_id) >= (latest_prices.upload_ts, latest_prices.product_id)''',
+              (after_id,))
+    bump_data_version(conn)
+
+# Copia consistente de la base con la API de backup, por pasos para no bloquear a los escritores
+def backup_database(conn, path):
+    target = sqlite3.connect(path)
+    try:
+        conn.backup(target, pages=app.config['EXPORT_BACKUP_PAGES'], sleep=0.005)
+    finally:
+        target.close()
+
+# Generar los productos como CSV o NDJSON comprimidos con gzip, fila por fila
+def export_products(conn, export_format, since=None):
+    columns = ('id', 'name', 'brand', 'price', 'place', 'upload_date', 'user_id')
+    c = conn.cursor()
+    if since:
+        c.execute('SELECT id, name, brand, price, place, upload_date, user_id FROM products '
+                  'WHERE upload_ts > ? ORDER BY upload_ts, id', (since,))
+    else:
+        c.execute('SELECT id, name, brand, price, place, upload_date, user_id FROM products ORDER BY id')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == 'csv':
+        writer.writerow(columns)
+    while True:
+        rows = c.fetchmany(app.config['EXPORT_BATCH_SIZE'])
+        if not rows:
+            break
+        if export_format == 'csv':
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                buffer.write('\n')
+        data = compressor.compress(buffer.getvalue().encode('utf-8'))
+        buffer.seek(0)
+        buffer.truncate()
+        if data:
+            yield data
+    yield compressor.compress(buffer.getvalue().encode('utf-8')) + compressor.flush()
+
+# Distribución de mensajes del chat dentro del worker. Los suscriptores esperan en una
+# Condition (compatible con gevent) y el primero que despierta consulta la base por todos:
+# una sola consulta por intervalo sirve a todos los clientes conectados al worker.
+class ChatBroker:
+    def __init__(self, poll_interval, buffer_size):
+        self.poll_interval = poll_interval
+        self.messages = deque(maxlen=buffer_size)
+        self.last_id = None
+        self.last_poll = 0.0
+        self.polling = False
+        self.generation = 0
+        self.cond = threading.Condition()
+        self.counters = {'polls': 0, 'published': 0, 'subscribers': 0}
+
+    def publish(self, messages):
+        with self.cond:
+            for message in messages:
+                if self.last_id is None or message['id'] > self.last_id:
+                    self.messages.append(message)
+                    self.last_id = message['id']
+                    self.counters['published'] += 1
+            self.cond.notify_all()
+
+    def poll(self):
+        with self.cond:
+            # Si la base fue reemplazada, los ids en memoria ya no sirven
+            if self.generation != db_pool.generation:
+                self.generation = db_pool.generation
+                self.messages.clear()
+                self.last_id = None
+            if self.polling or time.monotonic() - self.last_poll < self.poll_interval:
+                return
+            self.polling = True
+            last_id = self.last_id
+        try:
+            # La conexión se toma y se devuelve enseguida: los streams no retienen conexiones del pool
+            conn = db_pool.acquire()
+            try:
+                if last_id is None:
+                    c = conn.cursor()
+                    c.execute('SELECT COALESCE(MAX(id), 0) FROM chat_messages')
+                    with self.cond:
+                        if self.last_id is None:
+                            self.last_id = c.fetchone()[0]
+                    messages = []
+                else:
+                    messages = fetch_chat_messages(conn, last_id, app.config['CHAT_BUFFER_SIZE'])
+            finally:
+                db_pool.release(conn)
+            self.publish(messages)
+        finally:
+            with self.cond:
+                self.polling = False
+                self.last_poll = time.monotonic()
+                self.counters['polls'] += 1
+
+    def _buffered_after(self, after_id):
+        # None si el cursor es más viejo que lo que hay en memoria (hay que ir a la base).
+        # Sólo se llama con after_id < last_id, así que una memoria vacía también obliga a ir a la base.
+        if not self.messages or after_id < self.messages[0]['id'] - 1:
+            return None
+        return [m for m in self.messages if m['id'] > after_id]
+
+    def wait_for(self, after_id, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            self.poll()
+            with self.cond:
+                if self.last_id is not None and after_id < self.last_id:
+                    messages = self._buffered_after(after_id)
+                    if messages is None:
+                        break
+                    if messages:
+                        return messages
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.cond.wait(min(remaining, self.poll_interval))
+        # El cliente estuvo desconectado más tiempo del que cubre la memoria
+        conn = db_pool.acquire()
+        try:
+            return fetch_chat_messages(conn, after_id, app.config['CHAT_BUFFER_SIZE'])
+        finally:
+            db_pool.release(conn)
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counters, buffered=len(self.messages), last_id=self.last_id)
+
+# Nombres de usuario por id, para no repetir el JOIN con users en cada página del chat
+username_cache = {}
+username_cache_lock = threading.Lock()
+username_cache_generation = [0]
+
+def get_usernames(conn, user_ids):
+    with username_cache_lock:
+        # Si la base fue reemplazada, los ids pueden corresponder a otros usuarios
+        if username_cache_generation[0] != db_pool.generation or len(username_cache) > app.config['USERNAME_CACHE_SIZE']:
+            username_cache.clear()
+            username_cache_generation[0] = db_pool.generation
+        missing = [user_id for user_id in set(user_ids) if user_id not in username_cache]
+    if missing:
+        c = conn.cursor()
+        c.execute(f"SELECT id, username FROM users WHERE id IN ({', '.join('?' * len(missing))})", missing)
+        found = dict(c.fetchall())
+        with username_cache_lock:
+            username_cache.update(found)
+    with username_cache_lock:
+        return {user_id: username_cache.get(user_id, '') for user_id in user_ids}
+
+# Convertir filas (id, user_id, message, ts) en mensajes con el nombre del autor
+def chat_rows_to_messages(conn, rows):
+    usernames = get_usernames(conn, [m[1] for m in rows])
+    return [{'id': m[0], 'username': usernames[m[1]], 'message': m[2], 'timestamp': format_timestamp(m[3])}
+            for m in rows]
+
+# Mensajes del chat posteriores a un id, en orden ascendente
+def fetch_chat_messages(conn, after_id, limit):
+    c = conn.cursor()
+    c.execute('''SELECT id, user_id, message, ts
+                 FROM chat_messages
+                 WHERE id > ?
+                 ORDER BY id
+                 LIMIT ?''', (after_id, limit))
+    return chat_rows_to_messages(conn, c.fetchall())
+
+# Una página del historial, de más nuevo a más viejo; before es el id del mensaje más viejo ya mostrado
+def fetch_chat_history(conn, limit, before=None):
+    c = conn.cursor()
+    if before:
+        c.execute('''SELECT id, user_id, message, ts
+                     FROM chat_messages
+                     WHERE (ts, id) < (SELECT ts, id FROM chat_messages WHERE id = ?)
+                     ORDER BY ts DESC, id DESC
+                     LIMIT ?''', (before, limit))
+    else:
+        c.execute('''SELECT id, user_id, message, ts
+                     FROM chat_messages
+                     ORDER BY ts DESC, id DESC
+                     LIMIT ?''', (limit,))
+    return chat_rows_to_messages(conn, c.fetchall())
+
+# Mover al archivo, por lotes, los mensajes más viejos que la retención configurada
+def archive_chat_messages(conn, days, batch_size):
+    cutoff = int(time.time()) - days * 86400
+    c = conn.cursor()
+    archived = 0
+    while True:
+        c.execute('SELECT id FROM chat_messages WHERE ts < ? ORDER BY ts, id LIMIT ?',
+                  (cutoff, batch_size))
+        ids = [row[0] for row in c.fetchall()]
+        if not ids:
+            return archived
+        placeholders = ', '.join('?' * len(ids))
+        c.execute(f'''INSERT OR IGNORE INTO chat_messages_archive (id, user_id, message, timestamp, ts)
+                      SELECT id, user_id, message, timestamp, ts FROM chat_messages WHERE id IN ({placeholders})''', ids)
+        c.execute(f'DELETE FROM chat_messages WHERE id IN ({placeholders})', ids)
+        # Un lote por transacción, para no retener el lock de escritura
+        conn.commit()
+        archived += len(ids)
+
+# Guardar un mensaje y avisar a los suscriptores de este worker
+def save_chat_message(conn, user, message):
+    timestamp, ts = get_current_timestamp()
+    c = conn.cursor()
+    c.execute('INSERT INTO chat_messages (user_id, message, timestamp, ts) VALUES (?, ?, ?, ?)',
+              (user.id, message, timestamp, ts))
+    conn.commit()
+    saved = {'id': c.lastrowid, 'username': user.username, 'message': message, 'timestamp': format_timestamp(ts)}
+    if chat_broker.last_id is not None and saved['id'] == chat_broker.last_id + 1:
+        chat_broker.publish([saved])
+    return saved
+
+chat_broker = ChatBroker(app.config['CHAT_POLL_INTERVAL'], app.config['CHAT_BUFFER_SIZE'])
+
+# Carrito guardado en la base: la sesión sólo lleva el id del carrito
+def get_cart_id(conn, create=False):
+    c = conn.cursor()
+    cart_id = session.get('cart_id')
+    if cart_id is None and current_user.is_authenticated:
+        # El usuario puede tener un carrito creado en otro dispositivo
+        c.execute('SELECT id FROM carts WHERE user_id = ?', (current_user.id,))
+        row = c.fetchone()
+        if row:
+            cart_id = session['cart_id'] = row[0]
+    legacy_items = session.pop('cart', None)
+    if cart_id is None and (create or legacy_items):
+        cart_id = secrets.token_urlsafe(16)
+        user_id = current_user.id if current_user.is_authenticated else None
+        # Dos requests simultáneos del mismo usuario pueden llegar acá a la vez: el segundo no inserta
+        # (índice único por user_id) y usa el carrito que creó el primero
+        c.execute('INSERT OR IGNORE INTO carts (id, user_id, created_at) VALUES (?, ?, ?)',
+                  (cart_id, user_id, get_current_time()))
+        if user_id is not None:
+            c.execute('SELECT id FROM carts WHERE user_id = ?', (user_id,))
+            cart_id = c.fetchone()[0]
+        session['cart_id'] = cart_id
+    # Carritos viejos guardados en la cookie: se pasan a la base una sola vez
+    for item in legacy_items or []:
+        add_cart_item(conn, cart_id, item['id'], item['price'])
+    conn.commit()
+    return cart_id
+
+def add_cart_item(conn, cart_id, product_id, price):
+    conn.cursor().execute('''INSERT INTO cart_items (cart_id, product_id, quantity, added_price, added_at)
+                             VALUES (?, ?, 1, ?, ?)
+                             ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = quantity + 1''',
+                          (cart_id, product_id, price, get_current_time()))
+
+# Al iniciar sesión, el carrito anónimo pasa a ser del usuario (o se fusiona con el que ya tenía)
+def claim_cart(conn, user_id):
+    c = conn.cursor()
+    cart_id = session.get('cart_id')
+    c.execute('SELECT id FROM carts WHERE user_id = ?', (user_id,))
+    row = c.fetchone()
+    if row is None:
+        if cart_id:
+            c.execute('UPDATE carts SET user_id = ? WHERE id = ? AND user_id IS NULL', (user_id, cart_id))
+    elif cart_id != row[0]:
+        if cart_id:
+            c.execute('''INSERT INTO cart_items (cart_id, product_id, quantity, added_price, added_at)
+                         SELECT ?, ci.product_id, ci.quantity, ci.added_price, ci.added_at
+                         FROM cart_items ci JOIN carts ON carts.id = ci.cart_id
+                         WHERE ci.cart_id = ? AND carts.user_id IS NULL
+                         ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity''',
+                      (row[0], cart_id))
+            c.execute('DELETE FROM cart_items WHERE cart_id = (SELECT id FROM carts WHERE id = ? AND user_id IS NULL)', (cart_id,))
+            c.execute('DELETE FROM carts WHERE id = ? AND user_id IS NULL', (cart_id,))
+        session['cart_id'] = row[0]
+    conn.commit()
+
+# Items del carrito con su precio actual (último precio del mismo producto en el mismo lugar)
+def get_cart_items(conn, cart_id):
+    c = conn.cursor()
+    c.execute('SELECT product_id, quantity, added_price FROM cart_items WHERE cart_id = ? ORDER BY added_at, product_id',
+              (cart_id,))
+    items = c.fetchall()
+    if not items:
+        return []
+    c.execute(f'''SELECT p.id, p.name, p.brand, p.place, COALESCE(lp.price, p.price)
+                  FROM products p
+                  LEFT JOIN latest_prices lp ON lp.name = p.name AND lp.brand = p.brand AND lp.place = p.place
+                  WHERE p.id IN ({', '.join('?' * len(items))})''', [item[0] for item in items])
+    products = {p[0]: p for p in c.fetchall()}
+    cart_items = []
+    for product_id, quantity, added_price in items:
+        product = products.get(product_id)
+        if product is None:
+            continue
+        cart_items.append({
+            'id': product_id,
+            'name': product[1],
+            'brand': product[2],
+            'place': product[3],
+            'price': product[4],
+            'added_price': added_price,
+            'price_change': product[4] - added_price,
+            'quantity': quantity,
+            'subtotal': product[4] * quantity,
+        })
+    return cart_items
+
+# Canasta más barata: costo del carrito en cada lugar con los últimos precios, el lugar más
+# barato que tiene todo y la mejor división entre como máximo max_stores lugares
+def optimize_basket(conn, cart_id, max_stores):
+    c = conn.cursor()
+    # Pivot en una sola consulta: cada producto del carrito contra su último precio en cada lugar
+    c.execute('''WITH wanted AS (
+                     SELECT p.name, p.brand, SUM(ci.quantity) AS quantity, MIN(ci.added_at) AS added_at
+                     FROM cart_items ci
+                     JOIN products p ON p.id = ci.product_id
+                     WHERE ci.cart_id = ?
+                     GROUP BY p.name COLLATE NOCASE, p.brand COLLATE NOCASE
+                 )
+                 SELECT w.name, w.brand, w.quantity, lp.place, lp.price
+                 FROM wanted w
+                 LEFT JOIN latest_prices lp ON lp.name = w.name AND lp.brand = w.brand
+                 ORDER BY w.added_at, w.name, lp.place''', (cart_id,))
+    rows = c.fetchall()
+    if not rows:
+        return None
+    items = list(dict.fromkeys((r[0], r[1], r[2]) for r in rows))
+    item_index = {item: i for i, item in enumerate(items)}
+    places = sorted({r[3] for r in rows if r[3] is not None})
+    place_index = {place: j for j, place in enumerate(places)}
+    unit_prices = np.full((len(items), len(places)), np.inf)
+    for name, brand, quantity, place, price in rows:
+        if place is not None:
+            unit_prices[item_index[(name, brand, quantity)], place_index[place]] = price
+    quantities = np.array([item[2] for item in items], dtype=float)
+
+    # Los productos sin precio en ningún lugar no entran en la optimización
+    available = np.isfinite(unit_prices).any(axis=1)
+    unavailable = [(items[i][0], items[i][1]) for i in np.flatnonzero(~available)]
+    costs = unit_prices[available] * quantities[available, None]
+    wanted = [items[i] for i in np.flatnonzero(available)]
+    if not wanted:
+        return {'stores': [], 'cheapest_store': None, 'split': None, 'unavailable': unavailable}
+
+    covered = np.isfinite(costs).sum(axis=0)
+    totals = np.where(np.isfinite(costs), costs, 0).sum(axis=0)
+    stores = sorted(
+        ({'place': places[j], 'total': float(totals[j]), 'covered': int(covered[j]),
+          'missing': len(wanted) - int(covered[j])} for j in range(len(places))),
+        key=lambda store: (store['missing'], store['total']))
+    cheapest_store = stores[0] if stores and stores[0]['missing'] == 0 else None
+
+    # Lugares candidatos: los de mejor cobertura y precio, más los que son los más baratos en algún producto
+    candidates = sorted(range(len(places)), key=lambda j: (-covered[j], totals[j]))[:app.config['BASKET_CANDIDATE_STORES']]
+    candidates = sorted(set(candidates) | set(np.argmin(costs, axis=1).tolist()))
+    best_total, best_combo = np.inf, None
+    for k in range(1, min(max_stores, len(candidates)) + 1):
+        combos = itertools.combinations(candidates, k)
+        while True:
+            chunk = np.array(list(itertools.islice(combos, 4096)), dtype=int)
+            if not len(chunk):
+                break
+            # costs[:, chunk] -> productos x combinaciones x k: el más barato dentro de cada combinación
+            chunk_totals = costs[:, chunk].min(axis=2).sum(axis=0)
+            i = int(np.argmin(chunk_totals))
+            if chunk_totals[i] < best_total:
+                best_total, best_combo = float(chunk_totals[i]), chunk[i]
+    split = None
+    if best_combo is not None:
+        choice = best_combo[np.argmin(costs[:, best_combo], axis=1)]
+        split = {
+            'places': [places[j] for j in best_combo],
+            'total': best_total,
+            'savings': cheapest_store['total'] - best_total if cheapest_store else None,
+            'assignments': [{'name': item[0], 'brand': item[1], 'quantity': item[2], 'place': places[j],
+                             'price': float(unit_prices[available][i, j])}
+                            for i, (item, j) in enumerate(zip(wanted, choice))],
+        }
+    return {'stores': stores, 'cheapest_store': cheapest_store, 'split': split, 'unavailable': unavailable}
+
+# Historial de precios: series por lugar agrupadas por día o semana, con caché por (producto, agrupación).
+# El período sale del epoch pasado a hora local, no del texto de upload_date
+PRICE_HISTORY_BUCKETS = {
+    'day': f"date(p.upload_ts - {ARGENTINA_UTC_OFFSET}, 'unixepoch')",
+    'week': f"date(p.upload_ts - {ARGENTINA_UTC_OFFSET}, 'unixepoch', '-6 days', 'weekday 1')",
+}
+
+class PriceHistoryCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key, version):
+        # Una entrada calculada con otra versión de los datos (o de otra base) ya no vale
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == version:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return entry[0]
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, key, version, series):
+        with self.lock:
+            self.entries[key] = (series, version)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            hit_ratio = self.counters['hits'] / lookups if lookups else 0.0
+            return dict(self.counters, size=len(self.entries), hit_ratio=hit_ratio)
+
+price_history_cache = PriceHistoryCache(app.config['PRICE_HISTORY_CACHE_SIZE'])
+
+# Versión de los datos de una tabla: la incrementan los triggers en cada cambio
+def get_data_change(conn, name='products'):
+    c = conn.cursor()
+    c.execute('SELECT version, updated_ts FROM data_versions WHERE name = ?', (name,))
+    return c.fetchone() or (0, 0)
+
+def get_data_version(conn, name='products'):
+    return (db_pool.generation, get_data_change(conn, name)[0])
+
+def bump_data_version(conn, name='products'):
+    conn.execute('''INSERT INTO data_versions (name, version, updated_ts) VALUES (?, 1, CAST(strftime('%s', 'now') AS INTEGER))
+                    ON CONFLICT (name) DO UPDATE SET version = version + 1, updated_ts = excluded.updated_ts''', (name,))
+
+# Series de min/promedio/max por lugar para varios productos (nombre + marca) en una sola consulta
+def price_history(conn, products, bucket, since_ts):
+    version = get_data_version(conn)
+    series = {}
+    missing = []
+    for name, brand in products:
+        key = (name.lower(), brand.lower(), bucket, since_ts)
+        cached = price_history_cache.get(key, version)
+        if cached is None:
+            missing.append((name, brand))
+        else:
+            series[(name, brand)] = cached
+    if missing:
+        found = {(name.lower(), brand.lower()): {} for name, brand in missing}
+        values = ', '.join('(?, ?)' for _ in missing)
+        c = conn.cursor()
+        # El JOIN recorre idx_products_compare: rango por nombre + marca y filtro de upload_ts sobre el índice
+        c.execute(f'''WITH wanted (name, brand) AS (VALUES {values})
+                      SELECT lower(w.name), lower(w.brand), p.place, {PRICE_HISTORY_BUCKETS[bucket]} AS period,
+                             MIN(p.price), AVG(p.price), MAX(p.price), COUNT(*)
+                      FROM wanted w
+                      JOIN products p ON p.name = w.name COLLATE NOCASE AND p.brand = w.brand COLLATE NOCASE
+                      WHERE p.upload_ts >= ?
+                      GROUP BY 1, 2, p.place, period
+                      ORDER BY 1, 2, p.place, period''',
+                  [value for product in missing for value in product] + [since_ts])
+        for name, brand, place, period, min_price, avg_price, max_price, count in c.fetchall():
+            found[(name, brand)].setdefault(place, []).append({
+                'period': period, 'min': min_price, 'avg': round(avg_price, 2), 'max': max_price, 'count': count,
+            })
+        for name, brand in missing:
+            stores = found[(name.lower(), brand.lower())]
+            price_history_cache.put((name.lower(), brand.lower(), bucket, since_ts), version, stores)
+            series[(name, brand)] = stores
+    return series
+
+# Tendencia de un producto: variación del promedio entre el primer y el último período con datos
+def price_trend(stores):
+    periods = {}
+    for points in stores.values():
+        for point in points:
+            total, count = periods.get(point['period'], (0, 0))
+            periods[point['period']] = (total + point['avg'] * point['count'], count + point['count'])
+    if not periods:
+        return None
+    first, last = min(periods), max(periods)
+    first_avg = periods[first][0] / periods[first][1]
+    last_avg = periods[last][0] / periods[last][1]
+    return {
+        'first_period': first,
+        'last_period': last,
+        'first_avg': round(first_avg, 2),
+        'last_avg': round(last_avg, 2),
+        'change_pct': round((last_avg - first_avg) / first_avg * 100, 2) if first_avg else None,
+    }
+
+# Tablas y columnas mínimas que debe tener una base subida (las que crea init_db)
+REQUIRED_SCHEMA = {
+    'products': {'id', 'name', 'brand', 'price', 'place', 'upload_date'},
+    'users': {'id', 'username', 'password', 'email'},
+    'chat_messages': {'id', 'user_id', 'message', 'timestamp'},
+}
+
+# Verificar la integridad y el esquema de una base subida antes de usarla
+def validate_database_file(path):
+    try:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    except sqlite3.Error as e:
+        raise ValueError(f'El archivo no es una base de datos SQLite válida: {e}')
+    try:
+        c = conn.cursor()
+        c.execute('PRAGMA integrity_check')
+        result = c.fetchone()
+        if not result or result[0] != 'ok':
+            raise ValueError(f'La base de datos está dañada: {result[0] if result else "sin resultado"}')
+        for table, required_columns in REQUIRED_SCHEMA.items():
+            c.execute(f'PRAGMA table_info({table})')
+            columns = {col[1] for col in c.fetchall()}
+            if not columns:
+                raise ValueError(f'Falta la tabla {table}.')
+            missing = required_columns - columns
+            if missing:
+                raise ValueError(f"A la tabla {table} le faltan las columnas: {', '.join(sorted(missing))}.")
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f'El archivo no es una base de datos SQLite válida: {e}')
+    finally:
+        conn.close()
+
+# Avisar a todos los workers que el contenido de la base cambió por completo
+def signal_database_replaced():
+    with open(DATABASE + '-swap', 'w') as f:
+        f.write(str(time.time()))
+    reset_db_connections()
+
+# Reemplazar el contenido de la base en vivo con la API de backup (los lectores nunca ven un archivo a medias)
+def replace_database(path):
+    source = sqlite3.connect(path)
+    target = db_pool._connect()
+    try:
+        # En modo WAL el destino no puede cambiar de tamaño de página: se adapta la copia subida
+        page_size = target.execute('PRAGMA page_size').fetchone()[0]
+        if source.execute('PRAGMA page_size').fetchone()[0] != page_size:
+            source.execute('PRAGMA journal_mode=DELETE')
+            source.execute(f'PRAGMA page_size={page_size}')
+            source.execute('VACUUM')
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+    signal_database_replaced()
+    # La base subida puede no tener (o tener desactualizados) los índices y tablas derivadas
+    init_db()
+    with get_db_connection() as conn:
+        rebuild_latest_prices(conn)
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+        conn.commit()
+    schedule_catalog_link()
+
+# Fusionar una base subida: sólo se insertan usuarios, productos y mensajes nuevos, por lotes
+def merge_database(path):
+    batch_size = app.config['MERGE_BATCH_SIZE']
+    report = {'users': 0, 'products': 0, 'chat_messages': 0}
+    conn = db_pool._connect()
+    try:
+        conn.execute('ATTACH DATABASE ? AS upload', (path,))
+        c = conn.cursor()
+        c.execute('''INSERT OR IGNORE INTO users (username, password, email)
+                     SELECT username, password, email FROM upload.users''')
+        report['users'] = c.rowcount
+        conn.commit()
+        # Los usuarios se emparejan por nombre: los ids pueden no coincidir entre bases
+        c.execute('''CREATE TEMP TABLE user_map AS
+                     SELECT uu.id AS upload_id, mu.id AS user_id
+                     FROM upload.users uu JOIN main.users mu ON mu.username = uu.username''')
+        c.execute('CREATE UNIQUE INDEX temp.idx_user_map ON user_map (upload_id)')
+        c.execute('PRAGMA upload.table_info(products)')
+        product_user = 'up.user_id' if 'user_id' in {col[1] for col in c.fetchall()} else '1'
+
+        c.execute('SELECT COALESCE(MAX(id), 0) FROM upload.products')
+        max_id = c.fetchone()[0]
+        for start in range(0, max_id, batch_size):
+            c.execute("INSERT INTO suspended_triggers (name) VALUES ('merge_database')")
+            c.execute('SELECT COALESCE(MAX(id), 0) FROM main.products')
+            last_id = c.fetchone()[0]
+            c.execute(f'''INSERT INTO main.products (name, brand, price, place, upload_date, upload_ts, user_id)
+                          SELECT up.name, up.brand, up.price, up.place, up.upload_date, {epoch_sql('up.upload_date')},
+                                 COALESCE(um.user_id, 1)
+                          FROM upload.products up
+                          LEFT JOIN user_map um ON um.upload_id = {product_user}
+                          WHERE up.id > ? AND up.id <= ?
+                            AND NOT EXISTS (
+                                SELECT 1 FROM main.products p
+                                WHERE p.name = up.name COLLATE NOCASE AND p.brand = up.brand COLLATE NOCASE
+                                  AND p.place = up.place AND p.upload_date = up.upload_date AND p.price = up.price
+                                  AND p.name = up.name AND p.brand = up.brand
+                            )
+                          ORDER BY up.id''', (start, start + batch_size))
+            report['products'] += c.rowcount
+            index_new_products(conn, last_id)
+            c.execute("DELETE FROM suspended_triggers WHERE name = 'merge_database'")
+            conn.commit()
+
+        c.execute('SELECT COALESCE(MAX(id), 0) FROM upload.chat_messages')
+        max_id = c.fetchone()[0]
+        for start in range(0, max_id, batch_size):
+            c.execute(f'''INSERT INTO main.chat_messages (user_id, message, timestamp, ts)
+                         SELECT um.user_id, ucm.message, ucm.timestamp, {epoch_sql('ucm.timestamp')}
+                         FROM upload.chat_messages ucm
+                         JOIN user_map um ON um.upload_id = ucm.user_id
+                         WHERE ucm.id > ? AND ucm.id <= ?
+                           AND NOT EXISTS (
+                               SELECT 1 FROM main.chat_messages cm
+                               WHERE cm.timestamp = ucm.timestamp AND cm.user_id = um.user_id AND cm.message = ucm.message
+                           )
+                         ORDER BY ucm.id''', (start, start + batch_size))
+            report['chat_messages'] += c.rowcount
+            conn.commit()
+    finally:
+        conn.rollback()
+        conn.close()
+    return report
+
+# Validar los campos de un producto (mismas reglas para el formulario y la importación)
+def validate_product(name, brand, price, place):
+    if not (name and brand and price and place):
+        raise ValueError('Por favor, completa todos los campos.')
+    try:
+        price = float(price)
+        # float() acepta 'nan' e 'inf': no son precios y romperían mínimos, máximos y promedios
+        if price < 0 or not math.isfinite(price):
+            raise ValueError("El precio no puede ser negativo")
+    except ValueError:
+        raise ValueError('Por favor, ingresa un precio válido (número positivo).')
+    return name, brand, price, place
+
+# Leer registros de un JSON (arreglo o un objeto por línea) sin cargar el archivo entero
+def iter_json_records(stream, chunk_size=65536):
+    head = stream.read(chunk_size)
+    if not head.lstrip().startswith('['):
+        # JSON Lines: un objeto por línea, se decodifica después
+        lines = itertools.chain(io.StringIO(head + stream.readline()), stream)
+        for number, line in enumerate(lines, start=1):
+            if line.strip():
+                yield number, line
+        return
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    buffer = head.lstrip()[1:]
+    pos = 0
+    number = 0
+    eof = False
+    while True:
+        pos = separators.match(buffer, pos).end()
+        if buffer.startswith(']', pos):
+            return
+        try:
+            record, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        number += 1
+        yield number, record
+
+# Recorrer un archivo CSV o JSON como (número de fila, dict)
+def iter_import_rows(stream, filename):
+    if filename.lower().endswith(('.json', '.jsonl', '.ndjson')):
+        for number, record in iter_json_records(stream):
+            if isinstance(record, str):
+                try:
+                    record = json.loads(record)
+                except json.JSONDecodeError as e:
+                    yield number, ValueError(f'JSON inválido: {e}')
+                    continue
+            yield number, record
+    else:
+        # La fila 1 es el encabezado
+        for number, record in enumerate(csv.DictReader(stream), start=2):
+            yield number, record
+
+# Importar productos en bloques con executemany, una transacción por bloque
+def import_products(conn, rows, user_id):
+    chunk_size = app.config['IMPORT_CHUNK_SIZE']
+    max_errors = app.config['IMPORT_MAX_REPORTED_ERRORS']
+    report = {'imported': 0, 'failed': 0, 'errors': []}
+    upload_date, upload_ts = get_current_timestamp()
+    c = conn.cursor()
+
+    def flush(batch):
+        # Todo el bloque va en una transacción: los demás nunca ven los triggers suspendidos
+        c.execute("INSERT INTO suspended_triggers (name) VALUES ('import_products')")
+        c.execute('SELECT COALESCE(MAX(id), 0) FROM products')
+        last_id = c.fetchone()[0]
+        # Sin ids del catálogo: los completa el vinculador en segundo plano (schedule_catalog_link)
+        c.executemany('INSERT INTO products (name, brand, price, place, upload_date, upload_ts, user_id) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+        index_new_products(conn, last_id)
+        c.execute("DELETE FROM suspended_triggers WHERE name = 'import_products'")
+        conn.commit()
+        report['imported'] += len(batch)
+
+    batch = []
+    for number, record in rows:
+        try:
+            if isinstance(record, Exception):
+                raise record
+            if not isinstance(record, dict):
+                raise ValueError('Cada registro debe ser un objeto con name, brand, price y place.')
+            fields = [record.get(key) for key in ('name', 'brand', 'price', 'place')]
+            fields = ['' if value is None else str(value).strip() for value in fields]
+            name, brand, price, place = validate_product(*fields)
+        except ValueError as e:
+            report['failed'] += 1
+            if len(report['errors']) < max_errors:
+                report['errors'].append((number, str(e)))
+            continue
+        batch.append((name, brand, price, place, upload_date, upload_ts, user_id))
+        if len(batch) >= chunk_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return report
+
+# Migraciones del esquema, en orden. PRAGMA user_version guarda cuántas se aplicaron,
+# así cada una corre una sola vez por base de datos.
+
+# 1. Tablas base (productos con user_id, usuarios, chat y tokens de recuperación)
+def migrate_base_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        brand TEXT NOT NULL,
+        price REAL NOT NULL,
+        place TEXT NOT NULL,
+        upload_date TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )''')
+    # Bases anteriores a la columna user_id: se agrega sin reescribir la tabla
+    c.execute("PRAGMA table_info(products)")
+    columns = [col[1] for col in c.fetchall()]
+    if 'user_id' not in columns:
+        c.execute('ALTER TABLE products ADD COLUMN user_id INTEGER NOT NULL DEFAULT 1 REFERENCES users(id)')
+        print("Columna user_id agregada a la tabla products con valor por defecto 1")
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL UNIQUE,
+        password TEXT NOT NULL,
+        email TEXT NOT NULL UNIQUE
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        message TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS password_reset_tokens (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        token TEXT NOT NULL,
+        expiry TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )''')
+
+# 2. Índice para la paginación por cursor del listado de productos
+def migrate_products_pagination_index(c):
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_upload_date_id ON products (upload_date, id)')
+
+# 3. Índice de texto completo (FTS5) sobre nombre, marca y lugar, sin distinguir acentos
+def migrate_products_search(c):
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, brand, place,
+        content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )''')
+    # Triggers que mantienen el índice sincronizado con products
+    # Los triggers de inserción se suspenden mientras una importación masiva indexa por bloques
+    c.execute('CREATE TABLE IF NOT EXISTS suspended_triggers (name TEXT PRIMARY KEY)')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products
+        WHEN NOT EXISTS (SELECT 1 FROM suspended_triggers) BEGIN
+        INSERT INTO products_fts (rowid, name, brand, place) VALUES (new.id, new.name, new.brand, new.place);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, name, brand, place) VALUES ('delete', old.id, old.name, old.brand, old.place);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name, brand, place ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, name, brand, place) VALUES ('delete', old.id, old.name, old.brand, old.place);
+        INSERT INTO products_fts (rowid, name, brand, place) VALUES (new.id, new.name, new.brand, new.place);
+    END''')
+    # Carga inicial del índice con los productos existentes
+    c.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+    # El nombre pesa más que la marca, y la marca más que el lugar
+    c.execute("INSERT INTO products_fts (products_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')")
+
+# 4. Índice de cobertura para la comparación de precios por lugar
+def migrate_products_compare_index(c):
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_products_compare
+                 ON products (name COLLATE NOCASE, brand COLLATE NOCASE, place, upload_date, price)''')
+
+# 5. Tabla resumida con el último precio de cada producto (nombre + marca) por lugar
+def migrate_latest_prices(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS latest_prices (
+        name TEXT NOT NULL COLLATE NOCASE,
+        brand TEXT NOT NULL COLLATE NOCASE,
+        place TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        price REAL NOT NULL,
+        upload_date TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (name, brand, place)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_latest_prices_upload_date ON latest_prices (upload_date, product_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_latest_prices_product ON latest_prices (product_id)')
+    # Triggers que mantienen latest_prices al insertar, editar o borrar productos
+    c.execute('''CREATE TRIGGER IF NOT EXISTS latest_prices_ai AFTER INSERT ON products
+        WHEN NOT EXISTS (SELECT 1 FROM suspended_triggers) BEGIN
+        INSERT INTO latest_prices (name, brand, place, product_id, price, upload_date, user_id)
+        VALUES (new.name, new.brand, new.place, new.id, new.price, new.upload_date, new.user_id)
+        ON CONFLICT (name, brand, place) DO UPDATE SET
+            name = excluded.name, brand = excluded.brand, product_id = excluded.product_id,
+            price = excluded.price, upload_date = excluded.upload_date, user_id = excluded.user_id
+        WHERE (excluded.upload_date, excluded.product_id) >= (latest_prices.upload_date, latest_prices.product_id);
+    END''')
+    # Los triggers y la carga inicial se escriben acá tal como eran en esta versión del esquema:
+    # la migración 9 los reemplaza cuando latest_prices pasa a ordenarse por upload_ts
+    refresh = {row: f'''DELETE FROM latest_prices WHERE name = {row}.name AND brand = {row}.brand AND place = {row}.place;
+        INSERT INTO latest_prices (name, brand, place, product_id, price, upload_date, user_id)
+        SELECT name, brand, place, id, price, upload_date, user_id FROM products
+        WHERE name = {row}.name COLLATE NOCASE AND brand = {row}.brand COLLATE NOCASE AND place = {row}.place
+        ORDER BY upload_date DESC, id DESC LIMIT 1;''' for row in ('old', 'new')}
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS latest_prices_au
+        AFTER UPDATE OF name, brand, price, place, upload_date, user_id ON products BEGIN
+        {refresh['old']}
+        {refresh['new']}
+    END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS latest_prices_ad AFTER DELETE ON products BEGIN
+        {refresh['old']}
+    END''')
+    c.execute('DELETE FROM latest_prices')
+    c.execute('''INSERT INTO latest_prices (name, brand, place, product_id, price, upload_date, user_id)
+                 SELECT name, brand, place, id, price, upload_date, user_id FROM (
+                     SELECT id, name, brand, place, price, upload_date, user_id,
+                            ROW_NUMBER() OVER (
+                                PARTITION BY name COLLATE NOCASE, brand COLLATE NOCASE, place
+                                ORDER BY upload_date DESC, id DESC
+                            ) AS rn
+                     FROM products
+                 ) WHERE rn = 1''')
+
+# 6. Índice para paginar el historial del chat y tabla de mensajes archivados
+def migrate_chat_history(c):
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chat_messages_timestamp_id ON chat_messages (timestamp, id)')
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_messages_archive (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        message TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )''')
+
+# 7. Carritos en la base (la cookie de sesión sólo guarda el id del carrito)
+def migrate_carts(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS carts (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )''')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_carts_user ON carts (user_id)')
+    c.execute('''CREATE TABLE IF NOT EXISTS cart_items (
+        cart_id TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 1,
+        added_price REAL NOT NULL,
+        added_at TEXT NOT NULL,
+        PRIMARY KEY (cart_id, product_id),
+        FOREIGN KEY (cart_id) REFERENCES carts(id),
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    )''')
+
+# 8. Contador de cambios de products, para invalidar cachés sin recorrer la tabla
+def migrate_data_versions(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )''')
+    c.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('products', 1)")
+    # Las importaciones masivas suspenden el trigger de inserción e incrementan la versión una vez por bloque
+    c.execute('''CREATE TRIGGER IF NOT EXISTS data_versions_products_ai AFTER INSERT ON products
+        WHEN NOT EXISTS (SELECT 1 FROM suspended_triggers) BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = 'products';
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS data_versions_products_au AFTER UPDATE ON products BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = 'products';
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS data_versions_products_ad AFTER DELETE ON products BEGIN
+        UPDATE data_versions SET version = version + 1 WHERE name = 'products';
+    END''')
+
+# 9. Fechas como epoch UTC enteras e indexadas; las columnas de texto se conservan para mostrar y exportar
+def migrate_epoch_timestamps(c):
+    for table, column in (('products', 'upload_ts'), ('latest_prices', 'upload_ts'),
+                          ('chat_messages', 'ts'), ('chat_messages_archive', 'ts')):
+        c.execute(f'PRAGMA table_info({table})')
+        if column not in {col[1] for col in c.fetchall()}:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+    c.execute(f"UPDATE products SET upload_ts = {epoch_sql('upload_date')}")
+    c.execute(f"UPDATE chat_messages SET ts = {epoch_sql('timestamp')}")
+    c.execute(f"UPDATE chat_messages_archive SET ts = {epoch_sql('timestamp')}")
+    # Las escrituras de la aplicación ya traen el epoch; estos triggers cubren a quien inserte sólo el texto
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS products_upload_ts_ai AFTER INSERT ON products
+        WHEN new.upload_ts = 0 BEGIN
+        UPDATE products SET upload_ts = {epoch_sql('new.upload_date')} WHERE id = new.id;
+    END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS chat_messages_ts_ai AFTER INSERT ON chat_messages
+        WHEN new.ts = 0 BEGIN
+        UPDATE chat_messages SET ts = {epoch_sql('new.timestamp')} WHERE id = new.id;
+    END''')
+    c.execute('DROP INDEX IF EXISTS idx_products_upload_date_id')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_upload_ts_id ON products (upload_ts, id)')
+    c.execute('DROP INDEX IF EXISTS idx_chat_messages_timestamp_id')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chat_messages_ts_id ON chat_messages (ts, id)')
+    c.execute('DROP INDEX IF EXISTS idx_latest_prices_upload_date')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_latest_prices_upload_ts ON latest_prices (upload_ts, product_id)')
+    # latest_prices elige el último precio por upload_ts: se recrean sus triggers y se reconstruye
+    for trigger in ('latest_prices_ai', 'latest_prices_au', 'latest_prices_ad'):
+        c.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    c.execute('''CREATE TRIGGER latest_prices_ai AFTER INSERT ON products
+        WHEN NOT EXISTS (SELECT 1 FROM suspended_triggers) BEGIN
+        INSERT INTO latest_prices (name, brand, place, product_id, price, upload_date, upload_ts, user_id)
+        VALUES (new.name, new.brand, new.place, new.id, new.price, new.upload_date, new.upload_ts, new.user_id)
+        ON CONFLICT (name, brand, place) DO UPDATE SET
+            name = excluded.name, brand = excluded.brand, product_id = excluded.product_id,
+            price = excluded.price, upload_date = excluded.upload_date, upload_ts = excluded.upload_ts,
+            user_id = excluded.user_id
+        WHERE (excluded.upload_ts, excluded.product_id) >= (latest_prices.upload_ts, latest_prices.product_id);
+    END''')
+    c.execute(f'''CREATE TRIGGER latest_prices_au
+        AFTER UPDATE OF name, brand, price, place, upload_date, upload_ts, user_id ON products BEGIN
+        {refresh_latest_price_sql('old')}
+        {refresh_latest_price_sql('new')}
+    END''')
+    c.execute(f'''CREATE TRIGGER latest_prices_ad AFTER DELETE ON products BEGIN
+        {refresh_latest_price_sql('old')}
+    END''')
+    rebuild_latest_prices(c.connection)
+
+# 10. Momento del último cambio de cada tabla, para Last-Modified en la API
+def migrate_data_versions_updated_ts(c):
+    c.execute('PRAGMA table_info(data_versions)')
+    if 'updated_ts' not in {col[1] for col in c.fetchall()}:
+        c.execute('ALTER TABLE data_versions ADD COLUMN updated_ts INTEGER NOT NULL DEFAULT 0')
+    c.execute("UPDATE data_versions SET updated_ts = CAST(strftime('%s', 'now') AS INTEGER)")
+    for trigger in ('data_versions_products_ai', 'data_versions_products_au', 'data_versions_products_ad'):
+        c.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    bump = '''UPDATE data_versions SET version = version + 1, updated_ts = CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE name = 'products';'''
+    c.execute(f'''CREATE TRIGGER data_versions_products_ai AFTER INSERT ON products
+        WHEN NOT EXISTS (SELECT 1 FROM suspended_triggers) BEGIN
+        {bump}
+    END''')
+    c.execute(f'''CREATE TRIGGER data_versions_products_au AFTER UPDATE ON products BEGIN
+        {bump}
+    END''')
+    c.execute(f'''CREATE TRIGGER data_versions_products_ad AFTER DELETE ON products BEGIN
+        {bump}
+    END''')
+
+# 11. Catálogo normalizado de productos y lugares, con índice de trigramas para sugerir coincidencias.
+# Los productos sin ids (existentes, importados o fusionados) los vincula el hilo de schedule_catalog_link o
+# flask backfill-catalog, por lotes.
+def migrate_catalog(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS catalog_products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        canonical_key TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        brand TEXT NOT NULL,
+        trigram_count INTEGER NOT NULL
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS stores (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        canonical_key TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        trigram_count INTEGER NOT NULL
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS catalog_trigrams (
+        trigram TEXT NOT NULL,
+        catalog_product_id INTEGER NOT NULL REFERENCES catalog_products (id),
+        PRIMARY KEY (trigram, catalog_product_id)
+    ) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS store_trigrams (
+        trigram TEXT NOT NULL,
+        store_id INTEGER NOT NULL REFERENCES stores (id),
+        PRIMARY KEY (trigram, store_id)
+    ) WITHOUT ROWID''')
+    c.execute('PRAGMA table_info(products)')
+    columns = {col[1] for col in c.fetchall()}
+    if 'catalog_product_id' not in columns:
+        c.execute('ALTER TABLE products ADD COLUMN catalog_product_id INTEGER REFERENCES catalog_products (id)')
+    if 'store_id' not in columns:
+        c.execute('ALTER TABLE products ADD COLUMN store_id INTEGER REFERENCES stores (id)')
+    # Comparación por ids enteros: último precio por lugar sin leer la tabla
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_products_catalog
+                 ON products (catalog_product_id, store_id, upload_ts, price)''')
+
+# 12. El índice de comparación ordena por upload_ts: lo usan el historial de precios y el recálculo de latest_prices
+def migrate_products_compare_upload_ts(c):
+    c.execute('DROP INDEX IF EXISTS idx_products_compare')
+    c.execute('''CREATE INDEX idx_products_compare
+                 ON products (name COLLATE NOCASE, brand COLLATE NOCASE, place, upload_ts, price)''')
+
+# 13. latest_prices guarda los ids del catálogo: la comparación lee sólo el último precio de cada variante
+# y products ya no necesita un índice por catálogo (que encarecía cada importación)
+def migrate_latest_prices_catalog(c):
+    c.execute('PRAGMA table_info(latest_prices)')
+    columns = {col[1] for col in c.fetchall()}
+    for column, table in (('catalog_product_id', 'catalog_products'), ('store_id', 'stores')):
+        if column not in columns:
+            c.execute(f'ALTER TABLE latest_prices ADD COLUMN {column} INTEGER REFERENCES {table} (id)')
+    # Las filas que llegan sin ids (triggers de products, reconstrucción) los toman de su producto. No hay
+    # trigger de UPDATE: obliga a SQLite a reescribir todos los índices en cada upsert de una importación,
+    # y una fila existente ya tiene los ids de su texto (las que no, las completa link_catalog).
+    c.execute('''CREATE TRIGGER IF NOT EXISTS latest_prices_catalog_ai
+        AFTER INSERT ON latest_prices WHEN new.catalog_product_id IS NULL BEGIN
+        UPDATE latest_prices SET (catalog_product_id, store_id) =
+            (SELECT catalog_product_id, store_id FROM products WHERE id = new.product_id)
+        WHERE rowid = new.rowid;
+    END''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_latest_prices_catalog ON latest_prices (catalog_product_id)')
+    c.execute('DROP INDEX IF EXISTS idx_products_catalog')
+
+# 14. Las importaciones guardan los productos sin ids del catálogo y el vinculador los completa después.
+# Un índice parcial le da los pendientes sin recorrer la tabla, y el trigger de latest_prices sólo copia
+# ids que existen (antes reescribía, con NULL, cada fila nueva de una importación).
+def migrate_products_unlinked_index(c):
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_unlinked ON products (id) WHERE catalog_product_id IS NULL')
+    c.execute('DROP TRIGGER IF EXISTS latest_prices_catalog_ai')
+    c.execute('''CREATE TRIGGER latest_prices_catalog_ai AFTER INSERT ON latest_prices
+        WHEN new.catalog_product_id IS NULL
+         AND EXISTS (SELECT 1 FROM products WHERE id = new.product_id AND catalog_product_id IS NOT NULL) BEGIN
+        UPDATE latest_prices SET (catalog_product_id, store_id) =
+            (SELECT catalog_product_id, store_id FROM products WHERE id = new.product_id)
+        WHERE rowid = new.rowid;
+    END''')
+
+MIGRATIONS = [
+    migrate_base_tables,
+    migrate_products_pagination_index,
+    migrate_products_search,
+    migrate_products_compare_index,
+    migrate_latest_prices,
+    migrate_chat_history,
+    migrate_carts,
+    migrate_data_versions,
+    migrate_epoch_timestamps,
+    migrate_data_versions_updated_ts,
+    migrate_catalog,
+    migrate_products_compare_upload_ts,
+    migrate_latest_prices_catalog,
+    migrate_products_unlinked_index,
+]
+
+# Aplicar las migraciones pendientes. BEGIN IMMEDIATE toma el lock de escritura de la base,
+# así que si varios workers arrancan a la vez sólo uno migra y los demás ven la versión nueva.
+def run_migrations(conn):
+    deadline = time.monotonic() + app.config['MIGRATION_LOCK_TIMEOUT']
+    c = conn.cursor()
+    while True:
+        if conn.in_transaction:
+            conn.commit()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or time.monotonic() > deadline:
+                raise
+            continue
+        try:
+            c.execute('PRAGMA user_version')
+            version = c.fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.commit()
+                return
+            migration = MIGRATIONS[version]
+            migration(c)
+            c.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+            print(f"Migración {version + 1} aplicada: {migration.__name__}")
+        except BaseException:
+            conn.rollback()
+            raise
 
 # Crear las tablas y manejar migraciones
 def init_db():
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            # Tabla de productos (con user_id)
-            c.execute('''CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                brand TEXT NOT NULL,
-                price REAL NOT NULL,
-                place TEXT NOT NULL,
-                upload_date TEXT NOT NULL
-            )''')
-            # Verificar si la columna user_id existe; si no, agregarla
-            c.execute("PRAGMA table_info(products)")
-            columns = [col[1] for col in c.fetchall()]
-            if 'user_id' not in columns:
-                c.execute('ALTER TABLE products ADD COLUMN user_id INTEGER NOT NULL DEFAULT 1')
-                c.execute('''UPDATE products SET user_id = 1 WHERE user_id IS NULL''')
-                print("Columna user_id agregada a la tabla products con valor por defecto 1")
-            # Agregar la restricción de clave foránea (esto podría fallar si ya hay datos, así que lo manejamos con cuidado)
-            try:
-                c.execute('''CREATE TABLE IF NOT EXISTS products_temp (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    brand TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    place TEXT NOT NULL,
-                    upload_date TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )''')
-                c.execute('''INSERT INTO products_temp (id, name, brand, price, place, upload_date, user_id)
-                             SELECT id, name, brand, price, place, upload_date, user_id FROM products''')
-                c.execute('DROP TABLE products')
-                c.execute('ALTER TABLE products_temp RENAME TO products')
-            except sqlite3.Error as e:
-                print(f"Error al agregar la restricción de clave foránea: {e}")
-            # Tabla de usuarios
-            c.execute('''CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL UNIQUE,
-                password TEXT NOT NULL,
-                email TEXT NOT NULL UNIQUE
-            )''')
-            # Tabla de mensajes del chat
-            c.execute('''CREATE TABLE IF NOT EXISTS chat_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )''')
-            # Tabla para tokens de recuperación de contraseña
-            c.execute('''CREATE TABLE IF NOT EXISTS password_reset_tokens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                token TEXT NOT NULL,
-                expiry TEXT NOT NULL,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )''')
-            conn.commit()
+            # Camino rápido: la base ya está al día y no hace falta tomar ningún lock
+            c.execute('PRAGMA user_version')
+            if c.fetchone()[0] < len(MIGRATIONS):
+                run_migrations(conn)
         print("Base de datos inicializada correctamente")
     except sqlite3.Error as e:
         print(f"Error al crear la base de datos: {e}")
 
+# Caché de páginas públicas para visitantes anónimos. Las entradas se etiquetan con la versión de
+# products (la misma del ETag de la API): cualquier alta, edición o reemplazo de la base las invalida.
+class ResponseCache:
+    def __init__(self, max_size, max_bytes, directory=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.file_tag = None
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'file_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'bypasses': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _path(self, key, tag):
+        return os.path.join(self.directory, tag, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _store(self, key, tag, body, mimetype):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size_bytes -= len(old[1])
+            self.entries[key] = (tag, body, mimetype)
+            self.size_bytes += len(body)
+            while self.entries and (len(self.entries) > self.max_size or self.size_bytes > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.size_bytes -= len(evicted[1])
+                self.counters['evictions'] += 1
+
+    def get(self, key, tag):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == tag:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return entry[1], entry[2]
+        # Segundo nivel en disco, compartido entre los workers de gunicorn
+        if self.directory:
+            try:
+                with open(self._path(key, tag), 'rb') as f:
+                    mimetype, body = f.read().split(b'\n', 1)
+                mimetype = mimetype.decode('ascii')
+                self._store(key, tag, body, mimetype)
+                self.count('file_hits')
+                return body, mimetype
+            except (OSError, ValueError):
+                pass
+        self.count('misses')
+        return None
+
+    def put(self, key, tag, body, mimetype):
+        self._store(key, tag, body, mimetype)
+        self.count('stores')
+        if not self.directory:
+            return
+        try:
+            if tag != self.file_tag:
+                # Las páginas de versiones anteriores ya no se van a pedir
+                self.file_tag = tag
+                for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+                    if name != tag:
+                        shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            path = self._path(key, tag)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(mimetype.encode('ascii') + b'\n' + body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error al guardar la página en la caché: {e}")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['file_hits'] + self.counters['misses']
+            hits = self.counters['hits'] + self.counters['file_hits']
+            return dict(self.counters, size=len(self.entries), size_bytes=self.size_bytes,
+                        hit_ratio=hits / lookups if lookups else 0.0, directory=self.directory)
+
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_MAX_BYTES'],
+                               app.config['RESPONSE_CACHE_DIR'])
+
+# Sólo se cachean los GET anónimos y sin mensajes flash pendientes; X-Cache-Bypass: 1 la saltea
+def cached_page(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if (request.method != 'GET' or not app.config['RESPONSE_CACHE_SIZE'] or current_user.is_authenticated
+                or use_streaming() or session.get('_flashes')):
+            return view(*args, **kwargs)
+        if request.headers.get('X-Cache-Bypass'):
+            response_cache.count('bypasses')
+            response = make_response(view(*args, **kwargs))
+            response.headers['X-Cache'] = 'BYPASS'
+            return response
+        try:
+            tag = api_validators(get_db_connection())[0]
+        except sqlite3.Error as e:
+            print(f"Error al leer la versión de los datos: {e}")
+            return view(*args, **kwargs)
+        key = f'{request.path}?{urlencode(sorted(request.args.items(multi=True)))}'
+        cached = response_cache.get(key, tag)
+        if cached is not None:
+            response = app.response_class(cached[0], mimetype=cached[1])
+            response.headers['X-Cache'] = 'HIT'
+            return response
+        response = make_response(view(*args, **kwargs))
+        if (response.status_code == 200 and not response.is_streamed and 'Set-Cookie' not in response.headers
+                and not session.get('_flashes')):
+            response_cache.put(key, tag, response.get_data(), response.mimetype)
+        response.headers['X-Cache'] = 'MISS'
+        return response
+    return wrapper
+
+# Archivos estáticos con huella: la build (flask build-assets) guarda el hash de cada archivo en
+# static/asset-manifest.json; si no existe se calcula al arrancar. Las URLs llevan ?v=<hash> y se
+# sirven con caché inmutable, y el service worker precachea exactamente esas URLs.
+ASSET_MANIFEST = os.path.join(app.static_folder, 'asset-manifest.json')
+SERVICE_WORKER = os.path.join(app.static_folder, 'service-worker.js')
+
+def build_asset_manifest():
+    assets = {}
+    for root, _, files in os.walk(app.static_folder):
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            if path in (ASSET_MANIFEST, SERVICE_WORKER):
+                continue
+            with open(path, 'rb') as f:
+                assets[os.path.relpath(path, app.static_folder).replace(os.sep, '/')] = hashlib.sha256(f.read()).hexdigest()[:12]
+    # La versión cambia si cambia cualquier archivo o el propio service worker
+    digest = hashlib.sha256(json.dumps(assets, sort_keys=True).encode('utf-8'))
+    with open(SERVICE_WORKER, 'rb') as f:
+        digest.update(f.read())
+    return {'version': digest.hexdigest()[:12], 'assets': assets}
+
+def load_asset_manifest():
+    try:
+        with open(ASSET_MANIFEST, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return build_asset_manifest()
+
+asset_manifest = load_asset_manifest()
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == 'static' and 'v' not in values:
+        fingerprint = asset_manifest['assets'].get(values.get('filename'))
+        if fingerprint:
+            values['v'] = fingerprint
+
+@app.after_request
+def cache_fingerprinted_assets(response):
+    # Sólo la URL con la huella vigente es inmutable; sin ?v= vale la caché por defecto de Flask
+    if (request.endpoint == 'static' and response.status_code == 200 and request.args.get('v')
+            and request.args.get('v') == asset_manifest['assets'].get(request.view_args.get('filename'))):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['STATIC_ASSET_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+# El service worker se sirve desde la raíz (para controlar todo el sitio) con su lista de precache
+@app.route('/service-worker.js')
+def service_worker():
+    precache = {
+        'version': asset_manifest['version'],
+        'urls': [url_for('static', filename=filename) for filename in sorted(asset_manifest['assets'])],
+    }
+    with open(SERVICE_WORKER, encoding='utf-8') as f:
+        body = f'self.PRECACHE = {json.dumps(precache)};\n' + f.read()
+    response = app.response_class(body, mimetype='application/javascript')
+    response.cache_control.no_cache = True
+    return response
+
 # Servir el manifest.json
 @app.route('/manifest.json')
 def serve_manifest():
@@ -207,7 +2601,9 @@ def login():
                 user = c.fetchone()
                 if user and check_password_hash(user[2], password):
                     user_obj = User(user[0], user[1], user[3])
+                    user_cache.put(user_obj)
                     login_user(user_obj)
+                    claim_cart(conn, user_obj.id)
 
                     response = make_response(redirect(url_for('index')))
                     if remember:
@@ -234,7 +2630,7 @@ def login():
 @login_required
 def logout():
     logout_user()
-    session.pop('cart', None)
+    session.pop('cart_id', None)
     response = make_response(redirect(url_for('index')))
     response.set_cookie('username', '', expires=0)
     response.set_cookie('password_hash', '', expires=0)
@@ -243,47 +2639,38 @@ def logout():
 
 # Página principal (productos ordenados por fecha)
 @app.route('/')
+@cached_page
 def index():
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('SELECT id, name, brand, price, place, upload_date, user_id FROM products ORDER BY upload_date DESC')
-            products = c.fetchall()
-            products = [(p[0], p[1], p[2], p[3], p[4], to_argentina_time(p[5]), p[6]) for p in products]
+        return render_product_page('index.html')
     except sqlite3.Error as e:
         flash(f'Error al cargar productos: {e}')
         print(f"Error al cargar productos: {e}")
-        products = []
-    return render_template('index.html', products=products)
+        return render_template('index.html', products=[])
 
 # Subir producto
 @app.route('/upload', methods=['GET', 'POST'])
 @login_required
 def upload():
     if request.method == 'POST':
-        name = request.form['name']
-        brand = request.form['brand']
-        price = request.form['price']
-        place = request.form['place']
-
-        if not (name and brand and price and place):
-            flash('Por favor, completa todos los campos.')
-            return redirect(url_for('upload'))
-
         try:
-            price = float(price)
-            if price < 0:
-                raise ValueError("El precio no puede ser negativo")
-        except ValueError:
-            flash('Por favor, ingresa un precio válido (número positivo).')
+            name, brand, price, place = validate_product(request.form['name'], request.form['brand'],
+                                                         request.form['price'], request.form['place'])
+        except ValueError as e:
+            flash(str(e))
             return redirect(url_for('upload'))
 
         try:
             with get_db_connection() as conn:
                 c = conn.cursor()
-                c.execute('INSERT INTO products (name, brand, price, place, upload_date, user_id) VALUES (?, ?, ?, ?, ?, ?)',
-                          (name, brand, price, place, get_current_time(), current_user.id))
+                upload_date, upload_ts = get_current_timestamp()
+                [(catalog_product_id, store_id)] = catalog_ids(conn, [(name, brand, place)])
+                c.execute('INSERT INTO products (name, brand, price, place, upload_date, upload_ts, user_id, '
+                          'catalog_product_id, store_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (name, brand, price, place, upload_date, upload_ts, current_user.id,
+                           catalog_product_id, store_id))
                 conn.commit()
+                autocomplete.refresh(conn)
             flash('Producto subido exitosamente!')
             print("Producto guardado en la base de datos")
             return redirect(url_for('upload'))
@@ -294,6 +2681,36 @@ def upload():
 
     return render_template('upload.html')
 
+# Importar precios en masa desde un archivo CSV o JSON
+@app.route('/import_products', methods=['GET', 'POST'])
+@login_required
+def import_products_view():
+    report = None
+    if request.method == 'POST':
+        products_file = request.files.get('products_file')
+        if not products_file or products_file.filename == '':
+            flash('No se seleccionó ningún archivo.')
+            return redirect(url_for('import_products_view'))
+
+        if not products_file.filename.lower().endswith(('.csv', '.json', '.jsonl', '.ndjson')):
+            flash('El archivo debe ser .csv, .json, .jsonl o .ndjson')
+            return redirect(url_for('import_products_view'))
+
+        try:
+            stream = io.TextIOWrapper(products_file.stream, encoding='utf-8-sig', newline='')
+            with get_db_connection() as conn:
+                report = run_blocking(import_products, conn, iter_import_rows(stream, products_file.filename),
+                                      current_user.id)
+            schedule_catalog_link()
+            flash(f"Importación terminada: {report['imported']} productos importados, {report['failed']} filas con errores.")
+            print(f"Importación: {report['imported']} productos, {report['failed']} errores")
+        except (sqlite3.Error, UnicodeDecodeError, csv.Error, json.JSONDecodeError) as e:
+            flash(f'Error al importar los productos: {e}')
+            print(f"Error al importar los productos: {e}")
+            return redirect(url_for('import_products_view'))
+
+    return render_template('import_products.html', report=report)
+
 # Editar producto
 @app.route('/edit_product/<int:product_id>', methods=['GET', 'POST'])
 @login_required
@@ -301,7 +2718,7 @@ def edit_product(product_id):
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute('SELECT id, name, brand, price, place, upload_date, user_id FROM products WHERE id = ?', (product_id,))
+            c.execute('SELECT id, name, brand, price, place, upload_ts, user_id FROM products WHERE id = ?', (product_id,))
             product = c.fetchone()
             if not product:
                 flash('Producto no encontrado.')
@@ -313,30 +2730,22 @@ def edit_product(product_id):
                 return redirect(url_for('index'))
 
             if request.method == 'POST':
-                name = request.form['name']
-                brand = request.form['brand']
-                price = request.form['price']
-                place = request.form['place']
-
-                if not (name and brand and price and place):
-                    flash('Por favor, completa todos los campos.')
-                    return redirect(url_for('edit_product', product_id=product_id))
-
                 try:
-                    price = float(price)
-                    if price < 0:
-                        raise ValueError("El precio no puede ser negativo")
-                except ValueError:
-                    flash('Por favor, ingresa un precio válido (número positivo).')
+                    name, brand, price, place = validate_product(request.form['name'], request.form['brand'],
+                                                                 request.form['price'], request.form['place'])
+                except ValueError as e:
+                    flash(str(e))
                     return redirect(url_for('edit_product', product_id=product_id))
 
-                c.execute('UPDATE products SET name = ?, brand = ?, price = ?, place = ? WHERE id = ?',
-                          (name, brand, price, place, product_id))
+                [(catalog_product_id, store_id)] = catalog_ids(conn, [(name, brand, place)])
+                c.execute('UPDATE products SET name = ?, brand = ?, price = ?, place = ?, catalog_product_id = ?, '
+                          'store_id = ? WHERE id = ?',
+                          (name, brand, price, place, catalog_product_id, store_id, product_id))
                 conn.commit()
+                autocomplete.replace((product[1], product[2], product[4]), (name, brand, place))
                 flash('Producto actualizado exitosamente!')
                 return redirect(url_for('index'))
 
-            product = (product[0], product[1], product[2], product[3], product[4], to_argentina_time(product[5]), product[6])
             return render_template('edit_product.html', product=product)
     except sqlite3.Error as e:
         flash(f'Error al editar el producto: {e}')
@@ -345,36 +2754,298 @@ def edit_product(product_id):
 
 # Filtrar productos
 @app.route('/filter', methods=['GET', 'POST'])
+@cached_page
 def filter_products():
     products = []
     search_query = ''
     if request.method == 'POST':
         search_query = request.form.get('search', '').strip()
         try:
+            if not build_fts_query(search_query):
+                return render_product_page('filter.html', search_query=search_query)
             with get_db_connection() as conn:
-                c = conn.cursor()
-                query = '''SELECT id, name, brand, price, place, upload_date, user_id 
-                          FROM products 
-                          WHERE name LIKE ? OR brand LIKE ? OR place LIKE ? 
-                          ORDER BY upload_date DESC'''
-                c.execute(query, (f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'))
-                products = c.fetchall()
-                products = [(p[0], p[1], p[2], p[3], p[4], to_argentina_time(p[5]), p[6]) for p in products]
+                products = search_products(conn, search_query, get_page_size())
         except sqlite3.Error as e:
             flash(f'Error al buscar productos: {e}')
             print(f"Error al buscar productos: {e}")
     else:
         try:
-            with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute('SELECT id, name, brand, price, place, upload_date, user_id FROM products ORDER BY upload_date DESC')
-                products = c.fetchall()
-                products = [(p[0], p[1], p[2], p[3], p[4], to_argentina_time(p[5]), p[6]) for p in products]
+            return render_product_page('filter.html', search_query=search_query)
         except sqlite3.Error as e:
             flash(f'Error al cargar productos: {e}')
             print(f"Error al cargar productos: {e}")
     return render_template('filter.html', products=products, search_query=search_query)
 
+# Comparar el precio de un producto entre lugares
+@app.route('/compare', methods=['GET', 'POST'])
+def compare():
+    name = ''
+    brand = ''
+    comparison = None
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        brand = request.form.get('brand', '').strip()
+
+        if not (name and brand):
+            flash('Por favor, completa todos los campos.')
+            return redirect(url_for('compare'))
+
+        try:
+            with get_db_connection() as conn:
+                comparison = compare_prices(conn, name, brand)
+            if comparison is None:
+                flash('No se encontraron precios para ese producto.')
+        except sqlite3.Error as e:
+            flash(f'Error al comparar precios: {e}')
+            print(f"Error al comparar precios: {e}")
+    return render_template('compare.html', name=name, brand=brand, comparison=comparison)
+
+# API JSON versionada. Las respuestas se validan con ETag/Last-Modified a partir del contador de
+# cambios de products: una petición condicional sin cambios se responde sin consultar los datos.
+API_PREFIX = '/api/v1'
+API_PRODUCT_FIELDS = ('id', 'name', 'brand', 'price', 'place', 'upload_date', 'upload_ts', 'user_id')
+
+def json_response(payload, status=200):
+    if orjson is not None:
+        body = orjson.dumps(payload)
+    else:
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    return app.response_class(body, status=status, mimetype='application/json')
+
+def api_error(message, status):
+    return json_response({'error': message}, status)
+
+# Campos pedidos con ?fields=id,name,price (todos si no se indica)
+def get_api_fields():
+    fields = request.args.get('fields')
+    if not fields:
+        return API_PRODUCT_FIELDS
+    fields = tuple(dict.fromkeys(f.strip() for f in fields.split(',') if f.strip()))
+    unknown = [f for f in fields if f not in API_PRODUCT_FIELDS]
+    if unknown or not fields:
+        raise ValueError(f"Campos desconocidos: {', '.join(unknown)}. Disponibles: {', '.join(API_PRODUCT_FIELDS)}")
+    return fields
+
+def api_fields_params():
+    return {'fields': get_api_fields()}
+
+# Convierte filas (id, name, brand, price, place, upload_ts, user_id) en objetos con los campos pedidos
+def product_rows_to_json(rows, fields):
+    getters = {
+        'id': lambda r: r[0], 'name': lambda r: r[1], 'brand': lambda r: r[2], 'price': lambda r: r[3],
+        'place': lambda r: r[4], 'upload_date': lambda r: format_timestamp(r[5]), 'upload_ts': lambda r: r[5],
+        'user_id': lambda r: r[6],
+    }
+    selected = [(field, getters[field]) for field in fields]
+    return [{field: get(row) for field, get in selected} for row in rows]
+
+# Validadores de la respuesta: cambian con cada escritura en products o si se reemplaza la base
+def api_validators(conn):
+    version, updated_ts = get_data_change(conn)
+    file_tag = zlib.crc32(repr(db_pool.file_id).encode('utf-8'))
+    return f'{file_tag:x}-{version}', datetime.fromtimestamp(updated_ts, timezone.utc)
+
+# params lee y valida los argumentos antes de comparar validadores (un 304 nunca tapa un 400): lo que
+# devuelve se pasa a la vista y entra en el ETag, p. ej. una ventana de fechas que cambia con el día
+def conditional_api(view=None, params=None):
+    if view is None:
+        return lambda view: conditional_api(view, params)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if params is not None:
+            try:
+                kwargs.update(params())
+            except ValueError as e:
+                return api_error(str(e), 400)
+        try:
+            etag, last_modified = api_validators(get_db_connection())
+        except sqlite3.Error as e:
+            print(f"Error al leer la versión de los datos: {e}")
+            return api_error('Error al consultar la base de datos', 500)
+        if params is not None:
+            etag = f"{etag}-{zlib.crc32(repr(sorted(kwargs.items())).encode('utf-8')):x}"
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = request.if_modified_since is not None and request.if_modified_since >= last_modified.replace(microsecond=0)
+        response = app.response_class(status=304) if not_modified else view(*args, **kwargs)
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+@app.route(f'{API_PREFIX}/products')
+@conditional_api(params=api_fields_params)
+def api_products(fields):
+    try:
+        page = ProductPage(get_db_connection(), get_page_size(), request.args.get('after'), request.args.get('before')).fetch()
+    except sqlite3.Error as e:
+        print(f"Error al listar productos: {e}")
+        return api_error('Error al listar productos', 500)
+    return json_response({
+        'products': product_rows_to_json(page, fields),
+        'next': page.next_cursor,
+        'prev': page.prev_cursor,
+    })
+
+@app.route(f'{API_PREFIX}/products/<int:product_id>')
+@conditional_api(params=api_fields_params)
+def api_product(product_id, fields):
+    try:
+        c = get_db_connection().cursor()
+        c.execute('SELECT id, name, brand, price, place, upload_ts, user_id FROM products WHERE id = ?', (product_id,))
+        row = c.fetchone()
+    except sqlite3.Error as e:
+        print(f"Error al leer el producto: {e}")
+        return api_error('Error al leer el producto', 500)
+    if row is None:
+        return api_error('Producto no encontrado', 404)
+    return json_response(product_rows_to_json([row], fields)[0])
+
+def api_search_params():
+    search_query = request.args.get('q', '').strip()
+    if not search_query:
+        raise ValueError('Indica el texto a buscar en q')
+    return {'search_query': search_query, 'fields': get_api_fields()}
+
+@app.route(f'{API_PREFIX}/search')
+@conditional_api(params=api_search_params)
+def api_search(search_query, fields):
+    try:
+        products = search_products(get_db_connection(), search_query, get_page_size())
+    except sqlite3.Error as e:
+        print(f"Error al buscar productos: {e}")
+        return api_error('Error al buscar productos', 500)
+    return json_response({'query': search_query, 'products': product_rows_to_json(products, fields)})
+
+def api_compare_params():
+    name = request.args.get('name', '').strip()
+    brand = request.args.get('brand', '').strip()
+    if not (name and brand):
+        raise ValueError('Indica name y brand')
+    return {'name': name, 'brand': brand}
+
+@app.route(f'{API_PREFIX}/compare')
+@conditional_api(params=api_compare_params)
+def api_compare(name, brand):
+    try:
+        comparison = compare_prices(get_db_connection(), name, brand)
+    except sqlite3.Error as e:
+        print(f"Error al comparar precios: {e}")
+        return api_error('Error al comparar precios', 500)
+    if comparison is None:
+        return api_error('No se encontraron precios para ese producto', 404)
+    prices = [{'place': place, 'price': price, 'upload_date': format_timestamp(upload_ts), 'upload_ts': upload_ts}
+              for place, price, upload_ts in comparison['prices']]
+    return json_response(dict(comparison, name=name, brand=brand, prices=prices))
+
+# Sugerencias mientras se escribe: /api/v1/autocomplete?field=name&q=coca (field=any mezcla los tres campos)
+@app.route(f'{API_PREFIX}/autocomplete')
+def api_autocomplete():
+    field = request.args.get('field', 'any')
+    if field != 'any' and field not in AUTOCOMPLETE_FIELDS:
+        return api_error(f"field debe ser any, {', '.join(AUTOCOMPLETE_FIELDS)}", 400)
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', app.config['AUTOCOMPLETE_LIMIT'], type=int),
+                       app.config['AUTOCOMPLETE_LIMIT']))
+    try:
+        autocomplete.refresh(get_db_connection())
+    except sqlite3.Error as e:
+        print(f"Error al actualizar el autocompletado: {e}")
+    if field == 'any':
+        suggestions = {}
+        for name in AUTOCOMPLETE_FIELDS:
+            for item in autocomplete.search(name, query, limit):
+                if item['count'] > suggestions.get(item['value'], {'count': 0})['count']:
+                    suggestions[item['value']] = dict(item, field=name)
+        suggestions = sorted(suggestions.values(), key=lambda item: -item['count'])[:limit]
+    else:
+        suggestions = autocomplete.search(field, query, limit)
+    return json_response({'field': field, 'query': query, 'suggestions': suggestions})
+
+# Productos y lugares del catálogo parecidos a lo que se está cargando: ?name=coca cola&brand=coca&place=coto
+def api_catalog_suggest_params():
+    name = request.args.get('name', '').strip()
+    brand = request.args.get('brand', '').strip()
+    place = request.args.get('place', '').strip()
+    if not (name or brand or place):
+        raise ValueError('Indica name, brand o place')
+    return {'name': name, 'brand': brand, 'place': place}
+
+@app.route(f'{API_PREFIX}/catalog/suggest')
+@conditional_api(params=api_catalog_suggest_params)
+def api_catalog_suggest(name, brand, place):
+    limit = app.config['CATALOG_SUGGEST_LIMIT']
+    threshold = app.config['CATALOG_SUGGEST_THRESHOLD']
+    payload = {'products': [], 'stores': []}
+    try:
+        conn = get_db_connection()
+        if name or brand:
+            payload['products'] = catalog_suggestions(conn, 'catalog_products', f'{name} {brand}', limit, threshold)
+        if place:
+            payload['stores'] = catalog_suggestions(conn, 'stores', place, limit, threshold)
+    except sqlite3.Error as e:
+        print(f"Error al buscar sugerencias: {e}")
+        return api_error('Error al buscar sugerencias', 500)
+    return json_response(payload)
+
+# Últimos precios de todos los productos, en columnas, para la copia sin conexión de la PWA
+@app.route(f'{API_PREFIX}/snapshot')
+@conditional_api
+def api_snapshot():
+    fields = ('id', 'name', 'brand', 'price', 'place', 'upload_ts')
+    try:
+        c = get_db_connection().cursor()
+        c.execute('SELECT product_id, name, brand, price, place, upload_ts FROM latest_prices')
+        rows = c.fetchall()
+    except sqlite3.Error as e:
+        print(f"Error al generar la instantánea de precios: {e}")
+        return api_error('Error al generar la instantánea de precios', 500)
+    return json_response({'fields': fields, 'rows': rows})
+
+# Historial de precios en JSON: /api/v1/price_history?product=1&product=2&bucket=week&days=180
+# La ventana empieza a la medianoche local de hace `days` días: el ETag cambia cuando cambia el día
+def api_price_history_params():
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in PRICE_HISTORY_BUCKETS:
+        raise ValueError('bucket debe ser day o week')
+    days = max(1, min(request.args.get('days', 90, type=int), app.config['PRICE_HISTORY_MAX_DAYS']))
+    product_ids = request.args.getlist('product', type=int)
+    if not product_ids:
+        raise ValueError('Indica al menos un producto')
+    if len(product_ids) > app.config['PRICE_HISTORY_MAX_PRODUCTS']:
+        raise ValueError(f"Máximo {app.config['PRICE_HISTORY_MAX_PRODUCTS']} productos por consulta")
+    start = (datetime.now(argentina_tz) - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return {'bucket': bucket, 'product_ids': product_ids, 'since': start.strftime('%Y-%m-%d'),
+            'since_ts': int(start.timestamp())}
+
+@app.route(f'{API_PREFIX}/price_history')
+@conditional_api(params=api_price_history_params)
+def api_price_history(bucket, product_ids, since, since_ts):
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            placeholders = ', '.join('?' for _ in product_ids)
+            c.execute(f'SELECT id, name, brand FROM products WHERE id IN ({placeholders})', product_ids)
+            found = {row[0]: (row[1], row[2]) for row in c.fetchall()}
+            series = price_history(conn, list(dict.fromkeys(found.values())), bucket, since_ts)
+    except sqlite3.Error as e:
+        print(f"Error al consultar el historial de precios: {e}")
+        return api_error('Error al consultar el historial de precios', 500)
+    products = []
+    for product_id in product_ids:
+        if product_id not in found:
+            products.append({'product': product_id, 'error': 'Producto no encontrado'})
+            continue
+        name, brand = found[product_id]
+        stores = series[(name, brand)]
+        products.append({'product': product_id, 'name': name, 'brand': brand,
+                         'stores': stores, 'trend': price_trend(stores)})
+    return json_response({'bucket': bucket, 'since': since, 'products': products})
+
 # Chat universal (restringido a usuarios autenticados)
 @app.route('/chat', methods=['GET', 'POST'])
 @login_required
@@ -388,10 +3059,7 @@ def chat():
 
         try:
             with get_db_connection() as conn:
-                c = conn.cursor()
-                c.execute('INSERT INTO chat_messages (user_id, message, timestamp) VALUES (?, ?, ?)',
-                          (current_user.id, message, get_current_time()))
-                conn.commit()
+                save_chat_message(conn, current_user, message)
             flash('Mensaje enviado!')
             return redirect(url_for('chat'))
         except sqlite3.Error as e:
@@ -399,20 +3067,106 @@ def chat():
             print(f"Error al enviar el mensaje: {e}")
             return redirect(url_for('chat'))
 
+    before = request.args.get('before', type=int)
+    page_size = app.config['CHAT_PAGE_SIZE']
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute('''SELECT u.username, cm.message, cm.timestamp 
-                         FROM chat_messages cm 
-                         JOIN users u ON cm.user_id = u.id 
-                         ORDER BY cm.timestamp DESC LIMIT 50''')
-            messages = c.fetchall()
-            messages = [(m[0], m[1], to_argentina_time(m[2])) for m in messages]
+            messages = fetch_chat_history(conn, page_size, before)
+            messages = [(m['username'], m['message'], m['timestamp'], m['id']) for m in messages]
+            c.execute('SELECT COALESCE(MAX(id), 0) FROM chat_messages')
+            last_id = c.fetchone()[0]
     except sqlite3.Error as e:
         flash(f'Error al cargar los mensajes: {e}')
         print(f"Error al cargar los mensajes: {e}")
         messages = []
-    return render_template('chat.html', messages=messages)
+        last_id = 0
+    # Si la página vino llena, puede haber mensajes más viejos
+    older_cursor = messages[-1][3] if len(messages) == page_size else None
+    return render_template('chat.html', messages=messages, last_id=last_id, older_cursor=older_cursor)
+
+# Cursor del cliente: encabezado Last-Event-ID (reconexión de EventSource) o ?after=
+def get_chat_cursor():
+    try:
+        return int(request.headers.get('Last-Event-ID') or request.args.get('after', 0))
+    except ValueError:
+        return 0
+
+# Worker que puede sostener conexiones largas: gevent (sockets parcheados) o un servidor con hilos.
+# Con el worker sync de gunicorn cada stream ocupa el worker entero y lo mata el timeout.
+def supports_long_requests():
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('socket'):
+        return True
+    return bool(request.environ.get('wsgi.multithread'))
+
+# Stream de mensajes nuevos con Server-Sent Events
+@app.route('/chat/stream')
+@login_required
+def chat_stream():
+    after_id = get_chat_cursor()
+    # El stream puede durar minutos: la conexión del request vuelve al pool antes de empezar
+    release_db_connection(None)
+    heartbeat = app.config['CHAT_HEARTBEAT_SECONDS']
+    max_seconds = app.config['CHAT_STREAM_MAX_SECONDS']
+    if not supports_long_requests():
+        # Streams cortos: EventSource se reconecta solo y sigue desde Last-Event-ID
+        max_seconds = min(max_seconds, app.config['CHAT_SYNC_STREAM_MAX_SECONDS'])
+
+    def events(after_id):
+        with chat_broker.cond:
+            chat_broker.counters['subscribers'] += 1
+        try:
+            # El cliente reintenta a los 2 segundos cuando el stream se cierra
+            yield 'retry: 2000\n\n'
+            deadline = time.monotonic() + max_seconds
+            while time.monotonic() < deadline:
+                messages = chat_broker.wait_for(after_id, min(heartbeat, max(0.0, deadline - time.monotonic())))
+                if not messages:
+                    yield ': ping\n\n'
+                    continue
+                for message in messages:
+                    after_id = message['id']
+                    yield f"id: {message['id']}\ndata: {json.dumps(message, ensure_ascii=False)}\n\n"
+        finally:
+            with chat_broker.cond:
+                chat_broker.counters['subscribers'] -= 1
+
+    response = app.response_class(events(after_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Alternativa con long polling para clientes sin EventSource; con ?before= devuelve mensajes más viejos
+@app.route('/chat/messages')
+@login_required
+def chat_messages():
+    before = request.args.get('before', type=int)
+    if before:
+        with get_db_connection() as conn:
+            messages = fetch_chat_history(conn, app.config['CHAT_PAGE_SIZE'], before)
+        older_cursor = messages[-1]['id'] if len(messages) == app.config['CHAT_PAGE_SIZE'] else None
+        return jsonify(messages=messages, older_cursor=older_cursor)
+    after_id = get_chat_cursor()
+    release_db_connection(None)
+    messages = chat_broker.wait_for(after_id, app.config['CHAT_LONG_POLL_SECONDS'])
+    return jsonify(messages=messages)
+
+# Enviar un mensaje en JSON: {"message": "..."}
+@app.route('/chat/send', methods=['POST'])
+@login_required
+def chat_send():
+    data = request.get_json(silent=True) or {}
+    message = str(data.get('message', '')).strip()
+    if not message:
+        return jsonify(error='Por favor, escribe un mensaje.'), 400
+    try:
+        with get_db_connection() as conn:
+            saved = save_chat_message(conn, current_user, message)
+        return jsonify(saved), 201
+    except sqlite3.Error as e:
+        print(f"Error al enviar el mensaje: {e}")
+        return jsonify(error=f'Error al enviar el mensaje: {e}'), 500
 
 # Solicitar recuperación de contraseña
 @app.route('/forgot_password', methods=['GET', 'POST'])
@@ -474,6 +3228,7 @@ def reset_password(token):
                 c.execute('UPDATE users SET password = ? WHERE id = ?', (hashed_password, token_data[0]))
                 c.execute('DELETE FROM password_reset_tokens WHERE token = ?', (token,))
                 conn.commit()
+                user_cache.invalidate(token_data[0])
                 flash('Contraseña restablecida exitosamente. Por favor, inicia sesión.')
                 return redirect(url_for('login'))
 
@@ -495,17 +3250,9 @@ def add_to_cart(product_id):
                 flash('Producto no encontrado.')
                 return redirect(request.referrer or url_for('index'))
 
-            if 'cart' not in session:
-                session['cart'] = []
-
-            session['cart'].append({
-                'id': product[0],
-                'name': product[1],
-                'brand': product[2],
-                'price': product[3],
-                'place': product[4]
-            })
-            session.modified = True
+            cart_id = get_cart_id(conn, create=True)
+            add_cart_item(conn, cart_id, product[0], product[3])
+            conn.commit()
 
             flash(f'{product[1]} ({product[2]}) añadido al carrito.')
             return redirect(request.referrer or url_for('index'))
@@ -517,18 +3264,40 @@ def add_to_cart(product_id):
 # Ver el carrito
 @app.route('/cart')
 def cart():
-    cart_items = session.get('cart', [])
-    total_price = sum(item['price'] for item in cart_items) if cart_items else 0
-    return render_template('cart.html', cart_items=cart_items, total_price=total_price)
+    max_stores = request.args.get('max_stores', 2, type=int)
+    max_stores = max(1, min(max_stores, app.config['BASKET_MAX_STORES']))
+    basket = None
+    try:
+        with get_db_connection() as conn:
+            cart_id = get_cart_id(conn)
+            cart_items = get_cart_items(conn, cart_id) if cart_id else []
+            if cart_items:
+                basket = optimize_basket(conn, cart_id, max_stores)
+    except sqlite3.Error as e:
+        flash(f'Error al cargar el carrito: {e}')
+        print(f"Error al cargar el carrito: {e}")
+        cart_items = []
+    total_price = sum(item['subtotal'] for item in cart_items) if cart_items else 0
+    return render_template('cart.html', cart_items=cart_items, total_price=total_price, basket=basket,
+                           max_stores=max_stores, max_stores_limit=app.config['BASKET_MAX_STORES'])
 
 # Vaciar el carrito
 @app.route('/clear_cart', methods=['POST'])
 def clear_cart():
-    session.pop('cart', None)
+    try:
+        with get_db_connection() as conn:
+            cart_id = get_cart_id(conn)
+            if cart_id:
+                conn.execute('DELETE FROM cart_items WHERE cart_id = ?', (cart_id,))
+                conn.commit()
+    except sqlite3.Error as e:
+        flash(f'Error al vaciar el carrito: {e}')
+        print(f"Error al vaciar el carrito: {e}")
+        return redirect(url_for('cart'))
     flash('Carrito vaciado.')
     return redirect(url_for('cart'))
 
-# Descargar la base de datos
+# Descargar la base de datos (copia consistente) o exportar los productos en streaming
 @app.route('/download_db')
 @login_required
 def download_db():
@@ -536,16 +3305,47 @@ def download_db():
         flash('No tienes permiso para descargar la base de datos.')
         return redirect(url_for('index'))
 
+    export_format = request.args.get('format', 'db')
+    if export_format not in ('db', 'csv', 'ndjson'):
+        flash('Formato de exportación inválido.')
+        return redirect(url_for('index'))
+
+    since = request.args.get('since', '').strip() or None
+    if since:
+        try:
+            since = datetime.strptime(since, '%Y-%m-%d %H:%M:%S' if ' ' in since else '%Y-%m-%d')
+            since = int(argentina_tz.localize(since).timestamp())
+        except ValueError:
+            flash('La fecha "since" debe tener el formato AAAA-MM-DD o AAAA-MM-DD HH:MM:SS.')
+            return redirect(url_for('index'))
+
     try:
         if not os.path.exists(DATABASE):
             flash('La base de datos no existe.')
             return redirect(url_for('index'))
 
-        return send_file(DATABASE, as_attachment=True, download_name='database.db')
+        if export_format != 'db':
+            filename = f'products.{export_format}.gz'
+            response = app.response_class(
+                stream_with_context(export_products(get_db_connection(), export_format, since)),
+                mimetype='application/gzip')
+            response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+            return response
+
+        fd, snapshot = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(DATABASE) or None)
+        os.close(fd)
+        try:
+            run_blocking(backup_database, get_db_connection(), snapshot)
+            # El archivo se borra ya: el descriptor abierto mantiene los datos hasta terminar el envío
+            snapshot_file = open(snapshot, 'rb')
+        finally:
+            os.remove(snapshot)
+        return send_file(snapshot_file, as_attachment=True, download_name='database.db',
+                         mimetype='application/octet-stream')
     except Exception as e:
         flash(f'Error al descargar la base de datos: {e}')
         print(f"Error al descargar la base de datos: {e}")
-        return redirect(url(),'index')
+        return redirect(url_for('index'))
 
 # Subir una nueva base de datos
 @app.route('/upload_db', methods=['GET', 'POST'])
@@ -569,23 +3369,268 @@ def upload_db():
             flash('El archivo debe ser un archivo .db')
             return redirect(url_for('upload_db'))
 
-        try:
-            conn = sqlite3.connect(DATABASE)
-            conn.close()
+        mode = request.form.get('mode', 'replace')
+        if mode not in ('replace', 'merge'):
+            flash('Modo de importación inválido.')
+            return redirect(url_for('upload_db'))
 
-            db_file.save(DATABASE)
-            flash('Base de datos subida exitosamente.')
+        # La subida se guarda en un archivo temporal junto a la base y se valida antes de usarla
+        fd, upload_path = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(DATABASE) or None)
+        os.close(fd)
+        try:
+            db_file.save(upload_path)
+            validate_database_file(upload_path)
+            if mode == 'merge':
+                report = run_blocking(merge_database, upload_path)
+                schedule_catalog_link()
+                flash(f"Base de datos fusionada: {report['products']} productos, {report['chat_messages']} mensajes "
+                      f"y {report['users']} usuarios nuevos.")
+            else:
+                run_blocking(replace_database, upload_path)
+                flash('Base de datos subida exitosamente.')
             return redirect(url_for('index'))
+        except ValueError as e:
+            flash(f'La base de datos no es válida: {e}')
+            return redirect(url_for('upload_db'))
         except Exception as e:
             flash(f'Error al subir la base de datos: {e}')
             print(f"Error al subir la base de datos: {e}")
             return redirect(url_for('upload_db'))
+        finally:
+            os.remove(upload_path)
 
     return render_template('upload_db.html')
 
+# Tiempos por request: base de datos, plantillas y el resto (Python), en Server-Timing y en /metrics
+@app.before_request
+def start_request_timing():
+    if app.config['INSTRUMENTATION']:
+        g.request_timing = {'start': time.perf_counter(), 'db': 0.0, 'queries': 0, 'template': 0.0, 'template_start': None}
+
+def template_render_started(sender, template, context, **extra):
+    timing = g.get('request_timing')
+    if timing is not None:
+        timing['template_start'] = time.perf_counter()
+
+def template_render_finished(sender, template, context, **extra):
+    timing = g.get('request_timing')
+    if timing is not None and timing['template_start'] is not None:
+        timing['template'] += time.perf_counter() - timing['template_start']
+        timing['template_start'] = None
+
+if app.config['INSTRUMENTATION']:
+    before_render_template.connect(template_render_started, app)
+    template_rendered.connect(template_render_finished, app)
+
+@app.after_request
+def finish_request_timing(response):
+    timing = g.get('request_timing')
+    if timing is None:
+        return response
+    total = time.perf_counter() - timing['start']
+    python_time = max(total - timing['db'] - timing['template'], 0.0)
+    response.headers['Server-Timing'] = (
+        f'db;dur={timing["db"] * 1000:.2f};desc="{timing["queries"]} consultas", '
+        f'tpl;dur={timing["template"] * 1000:.2f}, app;dur={python_time * 1000:.2f}, total;dur={total * 1000:.2f}')
+    endpoint = request.endpoint or 'none'
+    metrics.inc('app_requests_total', (('endpoint', endpoint), ('method', request.method), ('status', response.status_code)))
+    metrics.observe('app_request_duration_seconds', (('endpoint', endpoint),), total)
+    metrics.inc('app_request_db_seconds_total', (('endpoint', endpoint),), timing['db'])
+    metrics.inc('app_request_template_seconds_total', (('endpoint', endpoint),), timing['template'])
+    return response
+
+# Profiler por muestreo: un hilo toma las pilas de todos los hilos del worker cada cierto intervalo
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.interval = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval, max_seconds):
+        with self.lock:
+            if self.running:
+                return
+            self.stop_event.clear()
+            self.interval = interval
+            self.started_at = time.time()
+            self.thread = threading.Thread(target=self._run, args=(interval, max_seconds), daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def _run(self, interval, max_seconds):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + max_seconds
+        while not self.stop_event.wait(interval) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            collapsed = []
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < 64:
+                    stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                collapsed.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(collapsed)
+                self.samples += 1
+
+    def report(self, limit):
+        with self.lock:
+            leaves = Counter()
+            for stack, count in self.stacks.items():
+                leaves[stack.rsplit(';', 1)[-1]] += count
+            return {
+                'running': self.running,
+                'samples': self.samples,
+                'interval': self.interval,
+                'started_at': self.started_at,
+                'top_functions': leaves.most_common(limit),
+                'top_stacks': self.stacks.most_common(limit),
+            }
+
+    def collapsed(self):
+        # Formato de pilas colapsadas, el que usan flamegraph.pl y speedscope
+        with self.lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+profiler = SamplingProfiler()
+
+# Métricas Prometheus del worker. Con METRICS_TOKEN se exige "Authorization: Bearer <token>";
+# el administrador con su sesión también puede; localhost sólo con METRICS_TRUST_LOCALHOST=1.
+@app.route('/metrics')
+def metrics_view():
+    token = app.config['METRICS_TOKEN']
+    allowed = ((token and secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'))
+               or (current_user.is_authenticated and current_user.username == ADMIN_USERNAME)
+               or (app.config['METRICS_TRUST_LOCALHOST'] and request.remote_addr in ('127.0.0.1', '::1')))
+    if not allowed:
+        return app.response_class('Forbidden\n', status=403, mimetype='text/plain')
+    gauges = []
+    for prefix, stats in (('app_db_pool', db_pool.stats()), ('app_user_cache', user_cache.stats()),
+                          ('app_price_history_cache', price_history_cache.stats()),
+                          ('app_response_cache', response_cache.stats()), ('app_chat', chat_broker.stats()),
+                          ('app_autocomplete', autocomplete.stats())):
+        gauges.extend((f'{prefix}_{key}', value) for key, value in stats.items()
+                      if isinstance(value, (int, float)) and not isinstance(value, bool))
+    gauges.append(('app_instrumentation_enabled', int(app.config['INSTRUMENTATION'])))
+    gauges.append(('app_profiler_running', int(profiler.running)))
+    return app.response_class(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+# Profiler por muestreo del worker que atiende el pedido (sólo administrador):
+# POST action=start|stop|reset; GET devuelve el resumen en JSON o ?format=collapsed
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+@login_required
+def admin_profiler():
+    if current_user.username != ADMIN_USERNAME:
+        flash('No tienes permiso para usar el profiler.')
+        return redirect(url_for('index'))
+    if request.method == 'POST':
+        action = request.form.get('action') or (request.get_json(silent=True) or {}).get('action')
+        if action == 'start':
+            # Con gevent los hilos son greenlets cuyos ids no aparecen en sys._current_frames(): no hay muestras útiles
+            if gevent_threads_patched():
+                return jsonify(error='El profiler no funciona con el worker gevent; usar GUNICORN_WORKER_CLASS=gthread'), 409
+            profiler.start(app.config['PROFILER_INTERVAL'], app.config['PROFILER_MAX_SECONDS'])
+        elif action == 'stop':
+            profiler.stop()
+        elif action == 'reset':
+            profiler.reset()
+        else:
+            return jsonify(error='action debe ser start, stop o reset'), 400
+    if request.args.get('format') == 'collapsed':
+        return app.response_class(profiler.collapsed(), mimetype='text/plain')
+    return jsonify(profiler.report(request.args.get('limit', 30, type=int)))
+
+# Contadores del pool de conexiones y de la caché de usuarios (sólo administrador)
+@app.route('/db_stats')
+@login_required
+def db_stats():
+    if current_user.username != ADMIN_USERNAME:
+        flash('No tienes permiso para ver las estadísticas de la base de datos.')
+        return redirect(url_for('index'))
+    stats = db_pool.stats()
+    stats['user_cache'] = user_cache.stats()
+    stats['chat'] = chat_broker.stats()
+    stats['price_history_cache'] = price_history_cache.stats()
+    stats['response_cache'] = response_cache.stats()
+    stats['autocomplete'] = autocomplete.stats()
+    stats['slow_queries'] = list(slow_queries)
+    return jsonify(stats)
+
+# Comando para reconstruir latest_prices: flask rebuild-latest-prices
+@app.cli.command('rebuild-latest-prices')
+def rebuild_latest_prices_command():
+    with get_db_connection() as conn:
+        rebuild_latest_prices(conn)
+    print("Tabla latest_prices reconstruida")
+
+# Comando para vincular los productos existentes con el catálogo: flask backfill-catalog --batch-size 5000
+@app.cli.command('backfill-catalog')
+@click.option('--batch-size', type=int, default=None, help='Ids de productos procesados por transacción.')
+def backfill_catalog_command(batch_size):
+    batch_size = batch_size or app.config['CATALOG_BACKFILL_BATCH_SIZE']
+    with get_db_connection() as conn:
+        linked = backfill_catalog(conn, batch_size)
+        c = conn.cursor()
+        c.execute('SELECT (SELECT COUNT(*) FROM catalog_products), (SELECT COUNT(*) FROM stores)')
+        catalog_products, stores = c.fetchone()
+    print(f"{linked} productos vinculados: {catalog_products} productos y {stores} lugares en el catálogo")
+
+# Comando para importar precios: flask import-products archivo.csv --user-id 1
+@app.cli.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user-id', type=int, default=1, help='Usuario al que se asignan los productos importados.')
+def import_products_command(path, user_id):
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        with get_db_connection() as conn:
+            report = import_products(conn, iter_import_rows(f, path), user_id)
+            linked = backfill_catalog(conn, app.config['CATALOG_BACKFILL_BATCH_SIZE'])
+    print(f"{report['imported']} productos importados, {report['failed']} filas con errores, {linked} vinculados con el catálogo")
+    for number, error in report['errors']:
+        print(f"  Fila {number}: {error}")
+
+# Comando para archivar el chat viejo: flask archive-chat --days 90
+@app.cli.command('archive-chat')
+@click.option('--days', type=int, default=None, help='Antigüedad en días a partir de la cual se archivan los mensajes.')
+@click.option('--batch-size', type=int, default=None, help='Mensajes movidos por transacción.')
+def archive_chat_command(days, batch_size):
+    days = app.config['CHAT_RETENTION_DAYS'] if days is None else days
+    batch_size = batch_size or app.config['CHAT_ARCHIVE_BATCH_SIZE']
+    with get_db_connection() as conn:
+        archived = archive_chat_messages(conn, days, batch_size)
+    print(f"{archived} mensajes archivados (más viejos que {days} días)")
+
+# Comando para fijar las huellas de los estáticos en el deploy: flask build-assets
+@app.cli.command('build-assets')
+def build_assets_command():
+    manifest = build_asset_manifest()
+    with open(ASSET_MANIFEST, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f"{len(manifest['assets'])} archivos con huella, versión {manifest['version']}")
+
 # Inicializar la app
 with app.app_context():
     init_db()
+start_background_task(warm_autocomplete)
+schedule_catalog_link()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,279 @@
+# Benchmark de las rutas principales sobre una base sintética.
+#
+#   python benchmark.py --sizes 1000,10000,100000 --workers 4 --duration 5 --output bench.json
+#   python benchmark.py --compare bench-viejo.json bench.json
+#
+# Para cada tamaño se genera una base temporal (usuarios, productos en varios lugares con historial
+# de precios y chat), y cada proceso del driver importa la app apuntando a esa base (DATABASE_PATH)
+# y ejecuta las rutas con el cliente de pruebas de Flask. Todas las rutas se miden por fases: los
+# procesos arrancan cada ruta a la vez y la ejecutan durante --duration segundos.
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_PASSWORD = 'bench'
+
+PRODUCT_NAMES = ['Leche', 'Arroz', 'Fideos', 'Aceite', 'Azúcar', 'Harina', 'Yerba', 'Café', 'Galletitas', 'Queso',
+                 'Manteca', 'Yogur', 'Pan', 'Huevos', 'Atún', 'Tomate', 'Lentejas', 'Jabón', 'Detergente', 'Papel']
+PRESENTATIONS = ['500 g', '1 kg', '1 l', '1,5 l', 'x 6', 'x 12', 'chico', 'grande', 'light', 'integral']
+BRANDS = ['La Serenísima', 'Gallo', 'Matarazzo', 'Cocinero', 'Ledesma', 'Blancaflor', 'Taragüi', 'La Virginia',
+          'Terrabusi', 'Sancor', 'Arcor', 'Molto', 'Knorr', 'Skip', 'Higienol']
+SEARCH_TERMS = ['leche', 'arroz gallo', 'yerba', 'cafe', 'aceite 1', 'queso', 'fideos 500', 'jabon', 'galle']
+
+ROUTES = ['index', 'index_cached', 'filter', 'search', 'autocomplete', 'add_to_cart', 'cart', 'chat', 'chat_send', 'upload']
+
+
+def import_app(db_path):
+    os.environ['DATABASE_PATH'] = db_path
+    sys.path.insert(0, BASE_DIR)
+    import app as app_module
+    return app_module
+
+
+# Genera la base sintética: users usuarios, products productos distintos (nombre + marca) con precio en
+# una parte de los stores lugares, history reportes por producto y lugar, y messages mensajes de chat
+def generate_dataset(db_path, users, products, stores, history, messages, seed):
+    app_module = import_app(db_path)
+    rng = random.Random(seed)
+    now = datetime.now(app_module.argentina_tz)
+    password = app_module.generate_password_hash(BENCH_PASSWORD)
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.executemany('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
+                  [(f'bench{i}', password, f'bench{i}@example.com') for i in range(users)])
+    places = [f'Supermercado {i}' for i in range(stores)]
+    rows = []
+    for i in range(products):
+        name = f'{PRODUCT_NAMES[i % len(PRODUCT_NAMES)]} {PRESENTATIONS[(i // len(PRODUCT_NAMES)) % len(PRESENTATIONS)]} {i}'
+        brand = BRANDS[rng.randrange(len(BRANDS))]
+        base_price = rng.uniform(300, 9000)
+        for place in rng.sample(places, max(1, stores // 3)):
+            for _ in range(history):
+                uploaded = now - timedelta(days=rng.uniform(0, 180))
+                rows.append((name, brand, round(base_price * rng.uniform(0.8, 1.25), 2), place,
+                             uploaded.strftime('%Y-%m-%d %H:%M:%S'), int(uploaded.timestamp()), rng.randint(1, users)))
+    # Carga en bloque como la importación masiva: triggers suspendidos e índices en un solo paso
+    c.execute("INSERT INTO suspended_triggers (name) VALUES ('benchmark')")
+    c.executemany('INSERT INTO products (name, brand, price, place, upload_date, upload_ts, user_id) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    app_module.index_new_products(conn, 0)
+    c.execute("DELETE FROM suspended_triggers WHERE name = 'benchmark'")
+    chat = []
+    for i in range(messages):
+        sent = now - timedelta(seconds=rng.uniform(0, 90 * 86400))
+        chat.append((rng.randint(1, users), f'Mensaje de prueba {i}', sent.strftime('%Y-%m-%d %H:%M:%S'), int(sent.timestamp())))
+    chat.sort(key=lambda m: m[3])
+    c.executemany('INSERT INTO chat_messages (user_id, message, timestamp, ts) VALUES (?, ?, ?, ?)', chat)
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+    return len(rows)
+
+
+def make_request(client, route, rng, max_product_id):
+    if route == 'index':
+        return client.get('/', headers={'X-Cache-Bypass': '1'})
+    if route == 'index_cached':
+        return client.get('/')
+    if route == 'filter':
+        return client.get('/filter', headers={'X-Cache-Bypass': '1'})
+    if route == 'search':
+        return client.post('/filter', data={'search': rng.choice(SEARCH_TERMS)})
+    if route == 'autocomplete':
+        # Una tecla: prefijo de un término de búsqueda
+        term = rng.choice(SEARCH_TERMS)
+        return client.get('/api/v1/autocomplete', query_string={'field': 'any', 'q': term[:rng.randint(1, len(term))]})
+    if route == 'add_to_cart':
+        return client.post(f'/add_to_cart/{rng.randint(1, max_product_id)}')
+    if route == 'cart':
+        return client.get('/cart')
+    if route == 'chat':
+        return client.get('/chat')
+    if route == 'chat_send':
+        return client.post('/chat/send', json={'message': f'Hola {rng.random():.6f}'})
+    if route == 'upload':
+        return client.post('/upload', data={'name': f'{rng.choice(PRODUCT_NAMES)} benchmark', 'brand': rng.choice(BRANDS),
+                                            'price': f'{rng.uniform(100, 5000):.2f}', 'place': 'Supermercado 0'})
+    raise ValueError(f'Ruta desconocida: {route}')
+
+
+# Memoria residente actual del proceso en KB (None fuera de Linux). A diferencia de ru_maxrss, que es
+# el máximo desde que arrancó el proceso, permite ver cuánto crece cada ruta.
+def current_rss_kb():
+    try:
+        with open('/proc/self/statm', encoding='ascii') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+# Proceso del driver: un cliente anónimo para las páginas públicas y otro con sesión para el resto
+def run_worker(worker_id, db_path, users, routes, duration, seed, barrier, results):
+    app_module = import_app(db_path)
+    rng = random.Random(seed + worker_id)
+    anonymous = app_module.app.test_client()
+    client = app_module.app.test_client()
+    client.post('/login', data={'username': f'bench{worker_id % users}', 'password': BENCH_PASSWORD})
+    with app_module.app.app_context():
+        conn = app_module.get_db_connection()
+        max_product_id = conn.execute('SELECT MAX(id) FROM products').fetchone()[0]
+    for route in routes:
+        target = anonymous if route in ('index', 'index_cached', 'filter', 'autocomplete') else client
+        barrier.wait()
+        rss_before = current_rss_kb()
+        latencies = []
+        errors = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            t0 = time.perf_counter()
+            response = make_request(target, route, rng, max_product_id)
+            response.get_data()
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code >= 400:
+                errors += 1
+        elapsed = time.perf_counter() - start
+        # ru_maxrss es el pico del proceso hasta ahora (KB en Linux), incluye las rutas anteriores
+        results.put((worker_id, route, latencies, errors, elapsed, rss_before, current_rss_kb(),
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def summarize(samples):
+    routes = {}
+    for route in ROUTES:
+        entries = [s for s in samples if s[1] == route]
+        if not entries:
+            continue
+        latencies = np.array([value for entry in entries for value in entry[2]]) * 1000
+        elapsed = max(entry[4] for entry in entries)
+        measured = [entry for entry in entries if entry[5] is not None and entry[6] is not None]
+        routes[route] = {
+            'requests': int(latencies.size),
+            'errors': sum(entry[3] for entry in entries),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3) if latencies.size else None,
+            'p95_ms': round(float(np.percentile(latencies, 95)), 3) if latencies.size else None,
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3) if latencies.size else None,
+            'mean_ms': round(float(latencies.mean()), 3) if latencies.size else None,
+            'throughput_rps': round(latencies.size / elapsed, 1) if elapsed else None,
+            'rss_kb': max(entry[6] for entry in measured) if measured else None,
+            'rss_growth_kb': max(entry[6] - entry[5] for entry in measured) if measured else None,
+            'process_peak_rss_kb': max(entry[7] for entry in entries),
+        }
+    return routes
+
+
+def run_size(size, options):
+    tmp_dir = tempfile.mkdtemp(prefix='benchmark-')
+    db_path = os.path.join(tmp_dir, 'database.db')
+    ctx = multiprocessing.get_context('spawn')
+    try:
+        # La base se genera en otro proceso para que el driver arranque con la app sin estado previo
+        with ctx.Pool(1) as pool:
+            started = time.perf_counter()
+            reports = pool.apply(generate_dataset, (db_path, options.users, size, options.stores,
+                                                    options.history, options.messages, options.seed))
+            generated_in = time.perf_counter() - started
+        routes = [r for r in options.routes.split(',') if r]
+        barrier = ctx.Barrier(options.workers)
+        results = ctx.Queue()
+        workers = [ctx.Process(target=run_worker, args=(i, db_path, options.users, routes, options.duration,
+                                                         options.seed, barrier, results))
+                   for i in range(options.workers)]
+        for worker in workers:
+            worker.start()
+        samples = [results.get() for _ in range(options.workers * len(routes))]
+        for worker in workers:
+            worker.join()
+        return {
+            'products': size,
+            'price_reports': reports,
+            'database_bytes': os.path.getsize(db_path),
+            'generation_seconds': round(generated_in, 2),
+            'routes': summarize(samples),
+        }
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Compara dos resultados: variación de p95 y throughput por tamaño y ruta
+def compare(old_path, new_path):
+    with open(old_path, encoding='utf-8') as f:
+        old = {r['products']: r['routes'] for r in json.load(f)['results']}
+    with open(new_path, encoding='utf-8') as f:
+        new = {r['products']: r['routes'] for r in json.load(f)['results']}
+    print(f"{'productos':>10} {'ruta':<14} {'p95 antes':>10} {'p95 ahora':>10} {'var %':>8} {'rps antes':>10} {'rps ahora':>10}")
+    for size in sorted(set(old) & set(new)):
+        for route in ROUTES:
+            if route not in old[size] or route not in new[size]:
+                continue
+            before, after = old[size][route], new[size][route]
+            change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+            print(f"{size:>10} {route:<14} {before['p95_ms']:>10} {after['p95_ms']:>10} {change:>+8.1f} "
+                  f"{before['throughput_rps']:>10} {after['throughput_rps']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de las rutas del comparador de precios.')
+    parser.add_argument('--sizes', default='1000,10000', help='Cantidades de productos a probar, separadas por coma.')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--stores', type=int, default=20)
+    parser.add_argument('--history', type=int, default=3, help='Reportes de precio por producto y lugar.')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4, help='Procesos concurrentes del driver.')
+    parser.add_argument('--duration', type=float, default=5, help='Segundos por ruta.')
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None, help='Archivo JSON de resultados (por defecto bench-<commit>.json).')
+    parser.add_argument('--compare', nargs=2, metavar=('ANTES', 'AHORA'), help='Comparar dos archivos de resultados.')
+    options = parser.parse_args()
+
+    if options.compare:
+        compare(*options.compare)
+        return
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'options': {k: v for k, v in vars(options).items() if k not in ('output', 'compare')},
+        'results': [],
+    }
+    for size in (int(s) for s in options.sizes.split(',') if s):
+        print(f"Midiendo con {size} productos...")
+        result = run_size(size, options)
+        report['results'].append(result)
+        for route, stats in result['routes'].items():
+            print(f"  {route:<14} p50 {stats['p50_ms']:>8} ms  p95 {stats['p95_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms  "
+                  f"{stats['throughput_rps']:>8} req/s  errores {stats['errors']}")
+    output = options.output or f"bench-{commit or 'local'}.json"
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {output}")
+
+
+if __name__ == '__main__':
+    main()
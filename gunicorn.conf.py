@@ -0,0 +1,14 @@
+# Configuración de gunicorn: se lee sola al arrancar desde este directorio (gunicorn app:app)
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+# El chat mantiene abiertos streams SSE y long polling por minutos: con gevent cada conexión es una
+# greenlet y no ocupa un worker entero (con el worker sync el timeout los mataría a los 30 segundos).
+# Costo: todas las greenlets comparten un hilo del sistema. Lo que bloquea sin ceder (SQLite, Python que
+# usa CPU) frena a todo el worker, así que la app manda importaciones, copias y fusiones de la base, y las
+# reconstrucciones en segundo plano, al pool de hilos reales de gevent (run_blocking/start_background_task).
+# El profiler por muestreo no funciona con gevent: para perfilar, usar GUNICORN_WORKER_CLASS=gthread.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
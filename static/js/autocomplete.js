@@ -0,0 +1,60 @@
+// Sugerencias mientras se escribe: los campos con data-autocomplete="name|brand|place|any" usan un
+// <datalist> que se completa desde /api/v1/autocomplete, con debounce y cancelando los pedidos viejos
+const AUTOCOMPLETE_DELAY = 150;
+const AUTOCOMPLETE_CACHE_SIZE = 100;
+
+function debounce(fn, wait) {
+    let timer = null;
+    return (...args) => {
+        clearTimeout(timer);
+        timer = setTimeout(() => fn(...args), wait);
+    };
+}
+
+function setupAutocomplete(input) {
+    const list = document.createElement('datalist');
+    list.id = `${input.id || input.name}-autocomplete`;
+    input.setAttribute('list', list.id);
+    input.setAttribute('autocomplete', 'off');
+    input.after(list);
+    // Respuestas ya recibidas en esta página (al borrar letras no se vuelve a pedir)
+    const cache = new Map();
+    let controller = null;
+
+    const render = suggestions => {
+        list.replaceChildren(...suggestions.map(item => {
+            const option = document.createElement('option');
+            option.value = item.value;
+            return option;
+        }));
+    };
+
+    input.addEventListener('input', debounce(() => {
+        const query = input.value.trim();
+        if (!query || !navigator.onLine) {
+            render([]);
+            return;
+        }
+        if (cache.has(query)) {
+            render(cache.get(query));
+            return;
+        }
+        if (controller) {
+            controller.abort();
+        }
+        controller = new AbortController();
+        const params = new URLSearchParams({ field: input.dataset.autocomplete, q: query });
+        fetch(`/api/v1/autocomplete?${params}`, { signal: controller.signal })
+            .then(response => response.ok ? response.json() : { suggestions: [] })
+            .then(data => {
+                if (cache.size >= AUTOCOMPLETE_CACHE_SIZE) {
+                    cache.delete(cache.keys().next().value);
+                }
+                cache.set(query, data.suggestions);
+                render(data.suggestions);
+            })
+            .catch(() => undefined);
+    }, AUTOCOMPLETE_DELAY));
+}
+
+document.querySelectorAll('[data-autocomplete]').forEach(setupAutocomplete);
@@ -0,0 +1,109 @@
+// Copia local de los últimos precios en IndexedDB para poder buscar sin conexión
+const OFFLINE_DB_NAME = 'comparador-precios';
+const OFFLINE_SYNC_INTERVAL = 10 * 60 * 1000;
+
+function openOfflineDb() {
+    return new Promise((resolve, reject) => {
+        const open = indexedDB.open(OFFLINE_DB_NAME, 1);
+        open.onupgradeneeded = () => {
+            open.result.createObjectStore('prices', { keyPath: 'id' });
+            open.result.createObjectStore('meta');
+        };
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+function requestToPromise(request) {
+    return new Promise((resolve, reject) => {
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+// Descarga la instantánea sólo si cambió (ETag) y reemplaza la copia en una sola transacción
+async function syncOfflineSnapshot() {
+    const lastSync = Number(localStorage.getItem('offlineSnapshotSyncedAt') || 0);
+    if (!navigator.onLine || Date.now() - lastSync < OFFLINE_SYNC_INTERVAL) {
+        return;
+    }
+    const db = await openOfflineDb();
+    const etag = await requestToPromise(db.transaction('meta').objectStore('meta').get('etag'));
+    const response = await fetch('/api/v1/snapshot', { headers: etag ? { 'If-None-Match': etag } : {} });
+    localStorage.setItem('offlineSnapshotSyncedAt', String(Date.now()));
+    if (response.status !== 200) {
+        return;
+    }
+    const snapshot = await response.json();
+    const tx = db.transaction(['prices', 'meta'], 'readwrite');
+    const prices = tx.objectStore('prices');
+    prices.clear();
+    for (const row of snapshot.rows) {
+        const item = {};
+        snapshot.fields.forEach((field, i) => { item[field] = row[i]; });
+        prices.put(item);
+    }
+    tx.objectStore('meta').put(response.headers.get('ETag'), 'etag');
+}
+
+function normalizeText(text) {
+    return String(text).normalize('NFD').replace(/[\u0300-\u036f]/g, '').toLowerCase();
+}
+
+// Todas las palabras deben aparecer (como prefijo) en el nombre, la marca o el lugar
+async function searchOffline(query, limit = 50) {
+    const terms = normalizeText(query).split(/\s+/).filter(Boolean);
+    const db = await openOfflineDb();
+    const prices = await requestToPromise(db.transaction('prices').objectStore('prices').getAll());
+    return prices
+        .filter(item => {
+            const words = normalizeText(`${item.name} ${item.brand} ${item.place}`).split(/\s+/);
+            return terms.every(term => words.some(word => word.startsWith(term)));
+        })
+        .sort((a, b) => a.price - b.price)
+        .slice(0, limit);
+}
+
+function renderOfflineResults(list, results) {
+    list.replaceChildren();
+    if (!results.length) {
+        const empty = document.createElement('p');
+        empty.className = 'text-center';
+        empty.textContent = 'No se encontraron productos en la copia sin conexión.';
+        list.appendChild(empty);
+        return;
+    }
+    const formatter = new Intl.NumberFormat('es-AR', { style: 'currency', currency: 'ARS' });
+    for (const item of results) {
+        const li = document.createElement('li');
+        li.className = 'list-group-item d-flex align-items-center';
+        const info = document.createElement('div');
+        info.className = 'product-info';
+        for (const [cls, value] of [['product-name', item.name], ['product-brand', item.brand],
+                                    ['product-price', formatter.format(item.price)], ['product-place', item.place]]) {
+            const span = document.createElement('span');
+            span.className = cls;
+            span.textContent = value;
+            info.appendChild(span);
+        }
+        li.appendChild(info);
+        list.appendChild(li);
+    }
+}
+
+document.addEventListener('submit', event => {
+    const form = event.target;
+    if (!form.matches('[data-offline-search]') || navigator.onLine) {
+        return;
+    }
+    event.preventDefault();
+    const query = form.querySelector('[name="search"]').value;
+    const list = document.querySelector(form.dataset.offlineSearch);
+    searchOffline(query).then(results => renderOfflineResults(list, results));
+});
+
+window.addEventListener('load', () => {
+    if ('indexedDB' in window) {
+        syncOfflineSnapshot().catch(err => console.log('Error al sincronizar precios:', err));
+    }
+});
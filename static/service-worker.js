@@ -1,25 +1,93 @@
-const CACHE_NAME = 'price-compare-cache-v1';
-const urlsToCache = [
-    '/',
-    '/static/css/styles.css',
-    '/static/icons/icon-192x192.png',
-    '/static/icons/icon-512x512.png'
-];
+// self.PRECACHE ({version, urls}) lo agrega Flask al servir /service-worker.js: las URLs llevan la huella
+// de cada archivo, así que una versión nueva del sitio instala un caché nuevo y borra el anterior.
+const PRECACHE = self.PRECACHE || { version: 'dev', urls: [] };
+const PRECACHE_NAME = `precache-${PRECACHE.version}`;
+const RUNTIME_NAME = `runtime-${PRECACHE.version}`;
+
+// Páginas de listados: siempre la versión de la red (mensajes flash, cambios recién cargados) y la
+// guardada sólo sin conexión
+const NETWORK_FIRST = [/^\/$/, /^\/filter$/, /^\/compare$/];
+// API JSON de lectura: se muestra lo guardado y se actualiza en segundo plano
+const STALE_WHILE_REVALIDATE = [/^\/api\/v1\/(products|search|compare|price_history)/];
+// Sesión, carrito y el resto de lo que depende del usuario: siempre a la red
+const NETWORK_ONLY = [/^\/(login|logout|register|forgot_password|reset_password)/, /^\/(cart|add_to_cart|clear_cart)/,
+                      /^\/(chat|upload|import_products|edit_product|download_db|upload_db|db_stats)/, /^\/api\/v1\/snapshot/];
 
 self.addEventListener('install', event => {
     event.waitUntil(
-        caches.open(CACHE_NAME)
-            .then(cache => {
-                return cache.addAll(urlsToCache);
-            })
+        caches.open(PRECACHE_NAME)
+            .then(cache => cache.addAll(PRECACHE.urls))
+            .then(() => self.skipWaiting())
     );
 });
 
-self.addEventListener('fetch', event => {
-    event.respondWith(
-        caches.match(event.request)
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(
+                names.filter(name => name !== PRECACHE_NAME && name !== RUNTIME_NAME)
+                    .map(name => caches.delete(name))
+            ))
+            .then(() => self.clients.claim())
+    );
+});
+
+function staleWhileRevalidate(event) {
+    return caches.open(RUNTIME_NAME).then(cache =>
+        cache.match(event.request).then(cached => {
+            const network = fetch(event.request)
+                .then(response => {
+                    if (response.ok) {
+                        cache.put(event.request, response.clone());
+                    }
+                    return response;
+                });
+            if (cached) {
+                event.waitUntil(network.catch(() => undefined));
+                return cached;
+            }
+            return network;
+        })
+    );
+}
+
+function networkFirst(event) {
+    return caches.open(RUNTIME_NAME).then(cache =>
+        fetch(event.request)
             .then(response => {
-                return response || fetch(event.request);
+                if (response.ok) {
+                    cache.put(event.request, response.clone());
+                }
+                return response;
             })
+            .catch(error => cache.match(event.request).then(cached => cached || Promise.reject(error)))
     );
-});
\ No newline at end of file
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET' || url.origin !== self.location.origin) {
+        return;
+    }
+    if (NETWORK_ONLY.some(pattern => pattern.test(url.pathname))) {
+        // Al entrar o salir de la sesión, las páginas guardadas muestran otro usuario
+        if (/^\/(login|logout)/.test(url.pathname)) {
+            event.waitUntil(caches.delete(RUNTIME_NAME));
+        }
+        return;
+    }
+    if (url.pathname.startsWith('/static/') && url.searchParams.has('v')) {
+        event.respondWith(
+            caches.match(request).then(cached => cached || fetch(request))
+        );
+        return;
+    }
+    if (request.mode === 'navigate' && NETWORK_FIRST.some(pattern => pattern.test(url.pathname))) {
+        event.respondWith(networkFirst(event));
+        return;
+    }
+    if (STALE_WHILE_REVALIDATE.some(pattern => pattern.test(url.pathname))) {
+        event.respondWith(staleWhileRevalidate(event));
+    }
+});